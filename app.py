@@ -1,47 +1,140 @@
-from flask import Flask, request, jsonify, send_file
+import time
+
+# Boot timing starts before the first import
+BOOT_STARTED = time.perf_counter()
+
+from flask import Flask, Blueprint, current_app, g, request, jsonify, send_file
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.wsgi import ClosingIterator
 from flask_cors import CORS
-import yt_dlp
 import os
+import sys
 import json
+import logging
 from pathlib import Path
-import time
+from urllib.parse import quote
 import random
-from pytubefix import YouTube
-from pytubefix.cli import on_progress
-import requests
-from bs4 import BeautifulSoup
-
-# Auto-update cookies from cnvmp3.com on startup
-print("=" * 60)
-print("STARTUP: Checking for cookies...")
-print("=" * 60)
-try:
-    from update_cookies import update_cookies
-    update_cookies()
-    print("[OK] Cookie update completed")
-except Exception as e:
-    print(f"[WARNING] Could not auto-update cookies: {e}")
-    import traceback
-    traceback.print_exc()
-print("=" * 60)
-
-app = Flask(__name__, static_folder='.', static_url_path='')
-CORS(app)
+import shutil
+import uuid
+import hashlib
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+from cache import MetadataCache, ResultCache, cache_key
+from locks import file_lock
+from ratelimit import RateLimiter, RateLimited, is_rate_limited
+from identities import IdentityPool, redact_proxy
+from streaming import select_stream_format, open_upstream, relay
+from jobs import JobQueue, QueueFull, JOB_RETRY_AFTER, JOB_TTL, sweep_stale
+from batch import zip_stream, run_windowed, BATCH_MAX_ITEMS
+from signing import UrlSigner, load_secret
+from hedging import BackendStats, Cancelled, run_hedged
+from postprocess import PostProcessPool
+from progress import ProgressReporter
+from sessions import YdlPool
+import segmented
+from prefetch import Prefetcher, PrefetchBudget, is_prefetchable
+from logs import configure_logging
+import metrics
+
+from update_cookies import start_refresher
+from donations import DonationProgress
+from assets import AssetPipeline, FINGERPRINTED
+
+# yt-dlp, pytubefix, requests and bs4 are imported inside the functions that use
+# them, so serving pages and /api/health never loads the extractor stack.
+# preload_extractors() loads it up front (in the gunicorn master with preload_app,
+# so forked workers share it copy-on-write).
+HEAVY_MODULES = ('yt_dlp', 'pytubefix', 'requests', 'bs4')
+
+# Leveled logs to stderr (LOG_LEVEL, LOG_FORMAT=json for one JSON object per line)
+configure_logging()
+log = logging.getLogger(__name__)
+
+bp = Blueprint('main', __name__)
 
 DOWNLOAD_FOLDER = 'downloads'
 Path(DOWNLOAD_FOLDER).mkdir(exist_ok=True)
 
-# Rate limiting
-last_download_time = 0
-MIN_DOWNLOAD_INTERVAL = 8  # 8 seconds between downloads - more conservative
+# Every download gets its own scratch directory under here
+WORK_FOLDER = os.path.join(DOWNLOAD_FOLDER, 'work')
+Path(WORK_FOLDER).mkdir(exist_ok=True)
+
+# Finished files, shared by every worker (budget: CACHE_MAX_BYTES)
+result_cache = ResultCache(os.path.join(DOWNLOAD_FOLDER, 'cache'))
+
+# Signed, expiring links to cached files (same key in every worker)
+url_signer = UrlSigner(load_secret(os.path.join(DOWNLOAD_FOLDER, 'cache', 'url-secret')))
+
+# Lock files that let one worker download a video while identical requests wait
+LOCK_FOLDER = os.path.join(DOWNLOAD_FOLDER, 'locks')
+Path(LOCK_FOLDER).mkdir(exist_ok=True)
+
+# extract_info results, valid until their stream URLs expire (METADATA_TTL)
+metadata_cache = MetadataCache(os.path.join(DOWNLOAD_FOLDER, 'cache', 'metadata.db'))
+
+# Pages, styles and scripts: compressed, hashed and fingerprinted once at startup
+static_assets = AssetPipeline(os.path.dirname(os.path.abspath(__file__)))
+
+# Ko-fi goal progress, scraped by one worker per host; donations.json is the fallback
+donation_progress = DonationProgress(os.path.join(DOWNLOAD_FOLDER, 'cache', 'donations.json'),
+                                     os.path.join(os.path.dirname(os.path.abspath(__file__)), 'donations.json'))
+DONATIONS_MAX_AGE = 30  # seconds, matches the page's polling interval
+
+# Rate limiting: adaptive token bucket per egress identity, shared by all workers
+rate_limiter = RateLimiter(os.path.join(DOWNLOAD_FOLDER, 'cache', 'ratelimit.db'))
+
+# Cookie files (cookies*.txt next to app.py) paired with proxies (PROXIES, HTTP_PROXY),
+# reloaded when the files change and scheduled by health score
+identity_pool = IdentityPool(os.path.join(DOWNLOAD_FOLDER, 'cache', 'identities.db'),
+                             os.path.dirname(os.path.abspath(__file__)))
+
+# pytubefix uses neither cookie files nor a proxy
+PYTUBEFIX_IDENTITY = 'pytubefix|direct'
+PYTUBEFIX_CLIENTS = ('WEB', 'IOS')
+PYTUBEFIX_MAX_HEIGHT = 360  # tallest progressive (audio + video) stream YouTube offers
+PYTUBEFIX_HEADERS = {'User-Agent': 'Mozilla/5.0', 'accept-language': 'en-US,en'}
+
+# ffmpeg merges/conversions run here, at most one per CPU core per host
+postprocess_pool = PostProcessPool(os.path.join(DOWNLOAD_FOLDER, 'cache', 'postprocess'))
+
+# Progress event streams (/api/jobs/<id>/events)
+SSE_POLL_INTERVAL = 0.5  # seconds between checks for changes
+SSE_KEEPALIVE = 15  # seconds
+SSE_MAX_DURATION = int(os.environ.get('SSE_MAX_DURATION', 60))  # seconds before the client reconnects
+SSE_RETRY_MS = 1000
+
+# Reverse proxies in front of gunicorn (nginx, Render's load balancer) that append
+# the client address to X-Forwarded-For; 0 when clients connect directly
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 1))
+
+# Audio is delivered in its native format unless MP3 is asked for
+AUDIO_FORMATS = ('original', 'mp3')
+
+# Success rate and latency per download backend, used to order and hedge them
+backend_stats = BackendStats(os.path.join(DOWNLOAD_FOLDER, 'cache', 'backends.db'))
+
+# Long-lived YoutubeDL instances per egress identity (extractor caches, cookies, connections)
+ydl_pool = YdlPool()
+
+# Extractions run here: request threads are plentiful (see gunicorn.conf.py), but
+# extraction is CPU- and memory-heavy, so only a few run at once per worker
+EXTRACT_WORKERS = int(os.environ.get('EXTRACT_WORKERS', 4))
+extract_executor = ThreadPoolExecutor(max_workers=EXTRACT_WORKERS, thread_name_prefix='extract')
+
+# Per-worker metric snapshots, merged by /api/metrics
+metrics.configure(os.path.join(DOWNLOAD_FOLDER, 'metrics'))
 
-def get_ydl_opts():
+def get_ydl_opts(identity=None):
     """Get base yt-dlp options with anti-bot measures (2024-2025 optimized)"""
     opts = {
         'quiet': False,
         'no_warnings': False,
         'nocheckcertificate': True,
 
+        # yt-dlp output goes through logging; progress comes from progress_hooks
+        'logger': logging.getLogger('yt_dlp'),
+        'noprogress': True,
+
         # 2024-2025 CRITICAL: Use ios, mweb, tv_embedded (most reliable without PO tokens)
         'extractor_args': {
             'youtube': {
@@ -51,13 +144,10 @@ def get_ydl_opts():
             }
         },
 
-        # CRITICAL: Add sleep intervals to mimic human behavior
-        'sleep_interval': 3,
-        'max_sleep_interval': 10,
-        'sleep_requests': 0.5,  # Sleep between API requests
+        # No fixed sleeps: pacing comes from rate_limiter, which backs off on 429/bot checks
 
-        # Connection optimization
-        'concurrent_fragments': 3,
+        # Connection optimization (fragment concurrency is set per download from its size)
+        'concurrent_fragment_downloads': 3,
         'retries': 10,
         'fragment_retries': 10,
         'skip_unavailable_fragments': True,
@@ -74,73 +164,87 @@ def get_ydl_opts():
             'Sec-Fetch-Mode': 'navigate',
             'Sec-Fetch-Site': 'none',
         },
-
-        # Rate limit handling
-        'ratelimit': 'abort',  # Abort if rate limited
     }
 
-    # Check if proxy is configured via environment variable
-    proxy = os.environ.get('HTTP_PROXY') or os.environ.get('HTTPS_PROXY')
-    if proxy:
-        opts['proxy'] = proxy
-        print(f"[OK] Using proxy: {proxy}")
+    # CRITICAL: Send from a cookie file/proxy identity chosen by health score (for production)
+    identity = identity or identity_pool.choose()
+    identity.apply(opts)
+    log.debug("Using identity %s", identity.key)
 
-    # CRITICAL: Try cookies files with rotation (for production)
-    # Check for multiple cookie files and rotate between them
-    import glob
-    cookie_files = sorted(glob.glob(os.path.join(os.path.dirname(__file__), 'cookies*.txt')))
-
-    if cookie_files:
-        # Rotate through available cookie files
-        # Use hash of current time to pseudo-randomly select
-        import hashlib
-        selector = int(hashlib.md5(str(time.time()).encode()).hexdigest(), 16)
-        selected_cookies = cookie_files[selector % len(cookie_files)]
+    return opts
 
-        opts['cookiefile'] = selected_cookies
-        print(f"[OK] Using {os.path.basename(selected_cookies)} for authentication ({len(cookie_files)} available)")
+def egress_identity(opts):
+    """Rate-limit key for the cookie file and proxy a set of yt-dlp options uses"""
+    if opts.get('cookiefile'):
+        cookies = os.path.basename(opts['cookiefile'])
+    elif opts.get('cookiesfrombrowser'):
+        cookies = 'browser'
     else:
-        print("[WARNING] No cookies*.txt files found! Production downloads may fail.")
-        print("   Get cookies: https://chrome.google.com/webstore/detail/get-cookiestxt-locally/cclelndahbckbenkjhflpdbgdldlbecc")
-        print("   Create multiple accounts and save as: cookies1.txt, cookies2.txt, cookies3.txt")
-
-        # Only use browser cookies locally where Chrome is installed
-        import platform
-        if platform.system() == 'Windows' or os.path.exists(os.path.expanduser('~/.config/google-chrome')):
-            try:
-                opts['cookiesfrombrowser'] = ('chrome',)
-                print("  Falling back to Chrome browser cookies")
-            except:
-                pass
+        cookies = 'no-cookies'
+    return f"{cookies}|{redact_proxy(opts['proxy']) if opts.get('proxy') else 'direct'}"
+
+def report_upstream(identity, error=None, latency=None):
+    """Feed the outcome of an upstream call to the rate limiter and identity pool"""
+    rate_limiter.report(identity, error)
+    identity_pool.report(identity, error is None, latency,
+                         bot_check=error is not None and is_rate_limited(error))
+
+def extract_info_cached(ydl, url, background=False, any_egress=False):
+    """extract_info(download=False) through the shared metadata cache
+
+    Cached info is only reused through the proxy that extracted it, since stream
+    URLs are bound to that address; any_egress takes an entry from any proxy
+    when only titles and formats are needed. Background extractions (prefetches)
+    only run if the rate limiter can spare a token right away, and raise
+    RateLimited otherwise.
+    """
+    proxy = ydl.params.get('proxy')
+    info = metadata_cache.get_any(url) if any_egress else metadata_cache.get(url, proxy)
+    if info is not None:
+        metrics.CACHE_LOOKUPS.inc(cache='metadata', result='hit')
+        log.info("Metadata cache hit: %s", info.get('title'))
+        return info
+    metrics.CACHE_LOOKUPS.inc(cache='metadata', result='miss')
+
+    identity = egress_identity(ydl.params)
+    if background:
+        rate_limiter.acquire(identity, max_wait=0, reserve=1)
+    else:
+        rate_limiter.acquire(identity)
+    started = time.time()
+    try:
+        if background:
+            # Already in a niced prefetch thread; EXTRACT_WORKERS slots are kept for requests
+            info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+        else:
+            info = ydl.sanitize_info(extract_executor.submit(ydl.extract_info, url, download=False).result())
+    except Exception as e:
+        report_upstream(identity, e)
+        raise
+    report_upstream(identity, latency=time.time() - started)
+    metrics.STAGE_SECONDS.observe(time.time() - started, stage='extract')
 
-    return opts
+    metadata_cache.put(url, info, proxy)
+    return info
+
+def download_with_pytubefix(url, download_type, quality, output_dir, client='WEB', on_progress=None):
+    """Download using pytubefix with the given client into output_dir. Returns the file path
+
+    Only used for qualities up to PYTUBEFIX_MAX_HEIGHT (see download_uncached).
+    """
+    from pytubefix import YouTube
 
-def download_with_pytubefix(url, download_type, quality):
-    """Download using pytubefix with WEB client"""
     try:
-        print(f"Trying pytubefix with URL: {url}, quality: {quality}")
+        log.info("pytubefix (%s): %s, quality %s", client, url, quality)
 
-        # Try WEB client first (more reliable without PO tokens)
-        try:
-            yt = YouTube(
-                url,
-                client='WEB',
-                use_oauth=False,
-                allow_oauth_cache=False
-            )
-            print(f"Video title: {yt.title}")
-            print(f"Available streams: {len(yt.streams)}")
-        except Exception as e:
-            print(f"WEB client failed: {e}, trying IOS...")
-            # Fallback to IOS client
-            yt = YouTube(
-                url,
-                client='IOS',
-                use_oauth=False,
-                allow_oauth_cache=False
-            )
-            print(f"Video title: {yt.title}")
-            print(f"Available streams: {len(yt.streams)}")
+        yt = YouTube(
+            url,
+            client=client,
+            use_oauth=False,
+            allow_oauth_cache=False,
+            on_progress_callback=on_progress
+        )
+        log.debug("pytubefix (%s): %r, %d streams", client, yt.title, len(yt.streams))
 
         if download_type == 'audio':
             # Get best audio stream
@@ -149,15 +253,15 @@ def download_with_pytubefix(url, download_type, quality):
                 stream = yt.streams.get_audio_only()
 
             if stream:
-                print(f"Selected audio stream: {stream}")
-                filepath = stream.download(output_path=DOWNLOAD_FOLDER)
+                log.debug("Selected audio stream: %s", stream)
+                filepath = download_pytubefix_stream(stream, output_dir, on_progress)
 
                 # Verify download
                 if filepath and os.path.exists(filepath) and os.path.getsize(filepath) > 1000:
-                    print(f"Audio download successful: {filepath}")
+                    log.info("pytubefix audio download successful: %s", filepath)
                     return filepath
                 else:
-                    print(f"Audio download failed or file too small")
+                    log.warning("pytubefix audio download failed or file too small")
                     return None
         else:
             # Try progressive first (video + audio combined), filter by quality
@@ -182,7 +286,7 @@ def download_with_pytubefix(url, download_type, quality):
 
             if not stream:
                 # No progressive streams (common for Shorts), get best adaptive
-                print("No progressive streams, trying adaptive streams...")
+                log.debug("No progressive streams, trying adaptive streams")
                 stream = yt.streams.filter(adaptive=True, file_extension='mp4', only_video=False).order_by('resolution').desc().first()
 
                 if not stream:
@@ -190,219 +294,366 @@ def download_with_pytubefix(url, download_type, quality):
                     stream = yt.streams.filter(file_extension='mp4').order_by('resolution').desc().first()
 
             if stream:
-                print(f"Selected video stream: {stream}")
-
-                # Check if this stream matches the requested quality
-                if quality:
-                    stream_quality = int(stream.resolution.replace('p', '')) if stream.resolution else 0
-                    # If user wants higher quality than what's available in progressive, use yt-dlp
-                    if quality > 360 and stream_quality <= 360:
-                        print(f"User requested {quality}p but only {stream_quality}p progressive available, falling back to yt-dlp for adaptive streams")
-                        return None
-
-                filepath = stream.download(output_path=DOWNLOAD_FOLDER)
+                log.debug("Selected video stream: %s", stream)
+                filepath = download_pytubefix_stream(stream, output_dir, on_progress)
 
                 # Verify download
                 if filepath and os.path.exists(filepath) and os.path.getsize(filepath) > 1000:
-                    print(f"Video download successful: {filepath} at {stream.resolution}")
+                    log.info("pytubefix video download successful: %s at %s", filepath, stream.resolution)
                     return filepath
                 else:
-                    print(f"Video download failed or file too small")
+                    log.warning("pytubefix video download failed or file too small")
                     return None
 
-        print("No suitable stream found")
+        log.info("pytubefix: no suitable stream found")
         return None
 
+    except Cancelled:
+        raise
     except Exception as e:
-        print(f"Pytubefix error: {type(e).__name__}: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.warning("pytubefix error: %s: %s", type(e).__name__, e, exc_info=log.isEnabledFor(logging.DEBUG))
+        report_upstream(PYTUBEFIX_IDENTITY, e)
         return None
 
-@app.route('/api/formats', methods=['POST'])
-def get_formats():
-    """Get available formats for a given URL"""
-    try:
-        data = request.get_json()
-        url = data.get('url')
+def native_audio_ext(f):
+    """Extension of an audio format once yt-dlp has extracted it without transcoding"""
+    ext = f.get('ext') or 'm4a'
+    if ext == 'webm':
+        # webm is stream-copied into the audio codec's own container
+        return 'ogg' if (f.get('acodec') or '').startswith('vorbis') else 'opus'
+    return ext
+
+def summarize_formats(info, audio_format='original'):
+    """Title, thumbnail and the video/audio choices offered for extracted info
+
+    Audio is listed with the extension it will be delivered in: native unless
+    audio_format is 'mp3'.
+    """
+    common_qualities = {
+        1080: 'Full HD (1080p)',
+        720: 'HD (720p)',
+        480: 'SD (480p)',
+        360: 'Low (360p)',
+        144: 'Very Low (144p)'
+    }
 
-        if not url:
-            return jsonify({'error': 'URL is required'}), 400
+    all_video_formats = []
+    all_audio_formats = []
 
-        ydl_opts = get_ydl_opts()
+    if 'formats' in info:
+        for f in info['formats']:
+            height = f.get('height')
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
+            if f.get('vcodec') != 'none' and height:
+                ext = f.get('ext', '')
 
-            common_qualities = {
-                1080: 'Full HD (1080p)',
-                720: 'HD (720p)',
-                480: 'SD (480p)',
-                360: 'Low (360p)',
-                144: 'Very Low (144p)'
-            }
+                if ext in ['mp4', 'webm', 'm4a']:
+                    filesize = f.get('filesize') or f.get('filesize_approx', 0)
 
-            all_video_formats = []
-            all_audio_formats = []
-
-            if 'formats' in info:
-                for f in info['formats']:
-                    height = f.get('height')
-
-                    if f.get('vcodec') != 'none' and height:
-                        ext = f.get('ext', '')
-
-                        if ext in ['mp4', 'webm', 'm4a']:
-                            filesize = f.get('filesize') or f.get('filesize_approx', 0)
-
-                            all_video_formats.append({
-                                'format_id': f['format_id'],
-                                'height': height,
-                                'ext': ext,
-                                'filesize': filesize,
-                                'fps': f.get('fps', 30),
-                                'has_audio': f.get('acodec') != 'none'
-                            })
-
-                    elif f.get('acodec') != 'none' and f.get('vcodec') == 'none':
-                        abr = f.get('abr', 0)
-                        if abr:
-                            all_audio_formats.append({
-                                'format_id': f['format_id'],
-                                'abr': abr,
-                                'ext': f.get('ext', 'mp3'),
-                                'filesize': f.get('filesize') or f.get('filesize_approx', 0)
-                            })
-
-            video_formats = []
-            seen_heights = set()
-
-            all_video_formats.sort(key=lambda x: (x['height'], x['filesize']), reverse=True)
-
-            for vf in all_video_formats:
-                height = vf['height']
-                if height in common_qualities and height not in seen_heights:
-                    video_formats.append({
-                        'format_id': vf['format_id'],
-                        'quality': common_qualities[height],
-                        'resolution': f"{height}p",
-                        'ext': 'mp4',
-                        'filesize': vf['filesize']
+                    all_video_formats.append({
+                        'format_id': f['format_id'],
+                        'height': height,
+                        'ext': ext,
+                        'filesize': filesize,
+                        'fps': f.get('fps', 30),
+                        'has_audio': f.get('acodec') != 'none'
                     })
-                    seen_heights.add(height)
 
-            audio_formats = []
-            target_bitrates = {96, 128, 256, 320}
-            seen_bitrates = set()
+            elif f.get('acodec') != 'none' and f.get('vcodec') == 'none':
+                abr = f.get('abr', 0)
+                if abr:
+                    all_audio_formats.append({
+                        'format_id': f['format_id'],
+                        'abr': abr,
+                        'ext': 'mp3' if audio_format == 'mp3' else native_audio_ext(f),
+                        'filesize': f.get('filesize') or f.get('filesize_approx', 0)
+                    })
 
-            all_audio_formats.sort(key=lambda x: x['abr'], reverse=True)
+    video_formats = []
+    seen_heights = set()
 
-            for af in all_audio_formats:
-                abr = round(af['abr'])
-                closest = min(target_bitrates, key=lambda x: abs(x - abr))
+    all_video_formats.sort(key=lambda x: (x['height'], x['filesize']), reverse=True)
 
-                if closest not in seen_bitrates and abs(closest - abr) < 30:
-                    audio_formats.append({
-                        'format_id': af['format_id'],
-                        'quality': f'{closest}kbps',
-                        'ext': 'mp3',
-                        'filesize': af['filesize']
-                    })
-                    seen_bitrates.add(closest)
-
-            if not video_formats and all_video_formats:
-                best = all_video_formats[0]
-                video_formats.append({
-                    'format_id': best['format_id'],
-                    'quality': f"{best['height']}p",
-                    'resolution': f"{best['height']}p",
-                    'ext': 'mp4',
-                    'filesize': best['filesize']
-                })
-
-            if not audio_formats and all_audio_formats:
-                best = all_audio_formats[0]
-                audio_formats.append({
-                    'format_id': best['format_id'],
-                    'quality': f"{round(best['abr'])}kbps",
-                    'ext': 'mp3',
-                    'filesize': best['filesize']
-                })
-
-            return jsonify({
-                'title': info.get('title', 'Unknown'),
-                'thumbnail': info.get('thumbnail', ''),
-                'duration': info.get('duration', 0),
-                'video_formats': video_formats,
-                'audio_formats': audio_formats
+    for vf in all_video_formats:
+        height = vf['height']
+        if height in common_qualities and height not in seen_heights:
+            video_formats.append({
+                'format_id': vf['format_id'],
+                'quality': common_qualities[height],
+                'resolution': f"{height}p",
+                'ext': 'mp4',
+                'filesize': vf['filesize']
             })
+            seen_heights.add(height)
 
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    audio_formats = []
+    target_bitrates = {96, 128, 256, 320}
+    seen_bitrates = set()
 
-@app.route('/api/download', methods=['POST'])
-def download_video():
-    """Download video/audio with pytubefix first, yt-dlp fallback"""
-    global last_download_time
+    all_audio_formats.sort(key=lambda x: x['abr'], reverse=True)
 
-    data = request.get_json()
-    url = data.get('url')
-    download_type = data.get('type', 'video')
-    quality = data.get('quality')
+    for af in all_audio_formats:
+        abr = round(af['abr'])
+        closest = min(target_bitrates, key=lambda x: abs(x - abr))
 
-    if not url:
-        return jsonify({'error': 'URL is required'}), 400
+        if closest not in seen_bitrates and abs(closest - abr) < 30:
+            audio_formats.append({
+                'format_id': af['format_id'],
+                'quality': f'{closest}kbps',
+                'ext': af['ext'],
+                'filesize': af['filesize']
+            })
+            seen_bitrates.add(closest)
+
+    if not video_formats and all_video_formats:
+        best = all_video_formats[0]
+        video_formats.append({
+            'format_id': best['format_id'],
+            'quality': f"{best['height']}p",
+            'resolution': f"{best['height']}p",
+            'ext': 'mp4',
+            'filesize': best['filesize']
+        })
 
-    # Rate limiting - wait if needed
-    current_time = time.time()
-    time_since_last = current_time - last_download_time
-    if time_since_last < MIN_DOWNLOAD_INTERVAL:
-        wait_time = MIN_DOWNLOAD_INTERVAL - time_since_last
-        print(f"Rate limiting: waiting {wait_time:.1f} seconds...")
-        time.sleep(wait_time)
+    if not audio_formats and all_audio_formats:
+        best = all_audio_formats[0]
+        audio_formats.append({
+            'format_id': best['format_id'],
+            'quality': f"{round(best['abr'])}kbps",
+            'ext': best['ext'],
+            'filesize': best['filesize']
+        })
 
-    last_download_time = time.time()
+    return {
+        'title': info.get('title', 'Unknown'),
+        'thumbnail': info.get('thumbnail', ''),
+        'duration': info.get('duration', 0),
+        'video_formats': video_formats,
+        'audio_formats': audio_formats
+    }
 
-    # Clear previous downloads
-    for file in os.listdir(DOWNLOAD_FOLDER):
-        try:
-            os.remove(os.path.join(DOWNLOAD_FOLDER, file))
-        except:
-            pass
+@bp.route('/api/formats', methods=['POST'])
+def get_formats():
+    """Get available formats for a given URL"""
+    try:
+        data = request.get_json()
+        url = data.get('url')
 
-    is_youtube = 'youtube.com' in url or 'youtu.be' in url
+        if not url:
+            return jsonify({'error': 'URL is required'}), 400
+        audio_format = data.get('audio_format', 'original')
+        if audio_format not in AUDIO_FORMATS:
+            return jsonify({'error': f"audio_format must be one of {', '.join(AUDIO_FORMATS)}"}), 400
 
-    # Try pytubefix first for YouTube VIDEO downloads only
-    # For audio, use yt-dlp to ensure proper MP3 conversion with FFmpeg
-    if is_youtube and download_type == 'video':
-        print("=" * 50)
-        print("ATTEMPTING PYTUBEFIX DOWNLOAD")
-        print("=" * 50)
-
-        filepath = download_with_pytubefix(url, download_type, quality)
-
-        if filepath and os.path.exists(filepath) and os.path.getsize(filepath) > 1000:
-            filename = os.path.basename(filepath)
-            print(f"SUCCESS: Pytubefix downloaded {filename}")
-            return send_file(
-                filepath,
-                as_attachment=True,
-                download_name=filename
-            )
-        else:
-            print("Pytubefix failed, falling back to yt-dlp...")
+        ydl_opts = get_ydl_opts()
+
+        with ydl_pool.borrow(ydl_opts) as ydl:
+            info = extract_info_cached(ydl, url, any_egress=True)
 
-    # Fallback to yt-dlp
-    print("=" * 50)
-    print("ATTEMPTING YT-DLP DOWNLOAD")
-    print("=" * 50)
+        return jsonify(summarize_formats(info, audio_format))
 
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def prefetch_metadata(url):
+    """Extract url into the metadata cache ahead of its download (runs in the prefetch pool)"""
+    outcome = 'failed'
     try:
-        ydl_opts = get_ydl_opts()
-        ydl_opts['outtmpl'] = os.path.join(DOWNLOAD_FOLDER, '%(title)s.%(ext)s')
+        with ydl_pool.borrow(get_ydl_opts()) as ydl:
+            extract_info_cached(ydl, url, background=True, any_egress=True)
+        outcome = 'done'
+    except RateLimited:
+        outcome = 'rate_limited'
+    finally:
+        metrics.PREFETCHES.inc(outcome=outcome)
+
+# Metadata prefetches requested by the page, at low priority and within a budget per client
+prefetcher = Prefetcher(prefetch_metadata)
+prefetch_budget = PrefetchBudget(os.path.join(DOWNLOAD_FOLDER, 'cache', 'prefetch.db'))
+
+@bp.route('/api/prefetch', methods=['POST'])
+def prefetch():
+    """Warm the metadata cache for a URL the user has entered but not submitted yet
+
+    Answers 200 with the formats summary if the URL is already warm, 202 if
+    a prefetch was queued (or is running), and 429 once the client's budget
+    is spent. Prefetching is best effort: errors are not reported.
+    """
+    url = ((request.get_json(silent=True) or {}).get('url') or '').strip()
+    if not is_prefetchable(url):
+        return jsonify({'error': 'A video URL is required'}), 400
+
+    info = metadata_cache.get_any(url)
+    if info is not None:
+        metrics.PREFETCHES.inc(outcome='warm')
+        return jsonify(dict(summarize_formats(info), status='warm'))
+    if prefetcher.is_pending(url):
+        return jsonify({'status': 'pending'}), 202
+
+    client = request.remote_addr or 'unknown'
+    if not prefetch_budget.allow(client):
+        metrics.PREFETCHES.inc(outcome='over_budget')
+        response = jsonify({'status': 'over_budget'})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(prefetch_budget.retry_after(client))
+        return response
+
+    status = prefetcher.submit(url)
+    metrics.PREFETCHES.inc(outcome=status)
+    return jsonify({'status': status}), 202
+
+class DownloadError(Exception):
+    """Raised when every download method failed"""
+
+
+def result_key(url, download_type, quality, audio_format=None, start=None, end=None):
+    """Result cache key; MP3 conversions and clips are cached apart from the full download"""
+    if download_type == 'audio' and audio_format == 'mp3':
+        download_type = 'audio-mp3'
+    if is_clip(start, end):
+        download_type = f'{download_type}@{clip_label(start, end)}'
+    return cache_key(url, download_type, quality)
+
+def is_clip(start, end):
+    """True if start/end (seconds) ask for less than the whole video"""
+    return bool(start) or end is not None
+
+def clip_label(start, end):
+    """Short label of a time range, e.g. 30-90s or 30s-end"""
+    return f'{start or 0:g}-{end:g}s' if end is not None else f'{start or 0:g}s-end'
+
+def perform_download(url, download_type='video', quality=None, work_dir=None, audio_format=None, progress=None,
+                     start=None, end=None):
+    """Download video/audio with pytubefix first, yt-dlp fallback. Returns the file path
+
+    Files are written only inside work_dir, so concurrent downloads (threads or
+    gunicorn workers) never see each other's files. Finished files are moved
+    into the result cache, and cache hits skip downloading altogether.
+
+    Identical downloads are single-flight: while one thread or worker process
+    holds the lock for a key, the others wait and then take the cached result.
+
+    progress is an optional ProgressReporter the backends publish to. start and
+    end (seconds) limit the download to that part of the video.
+    """
+    progress = progress or ProgressReporter(None)
+    key = result_key(url, download_type, quality, audio_format, start, end)
+    cached = result_cache.get(key)
+    if cached:
+        metrics.CACHE_LOOKUPS.inc(cache='result', result='hit')
+        log.info("Cache hit: %s", os.path.basename(cached))
+        return cached
+    metrics.CACHE_LOOKUPS.inc(cache='result', result='miss')
+
+    with file_lock(os.path.join(LOCK_FOLDER, f'{key}.lock')):
+        cached = result_cache.get(key)
+        if cached:
+            log.info("Cache hit after waiting for identical download: %s", os.path.basename(cached))
+            return cached
+
+        filepath = download_uncached(url, download_type, quality, work_dir, audio_format, progress, start, end)
+        return result_cache.put(key, filepath)
+
+def download_uncached(url, download_type, quality, work_dir, audio_format=None, progress=None, start=None, end=None):
+    """Download into work_dir, hedging across the pytubefix clients and yt-dlp
+
+    Each backend writes to its own subdirectory; see hedging.run_hedged.
+    """
+    backends = {
+        'yt-dlp': lambda attempt: download_with_ytdlp(
+            url, download_type, quality, os.path.join(work_dir, 'yt-dlp'), attempt, audio_format, progress,
+            start, end),
+    }
 
-        if download_type == 'audio':
-            # Download best audio and convert to MP3
+    # pytubefix only handles YouTube video downloads (yt-dlp picks and remuxes audio formats)
+    # and always fetches whole files, so clips are left to yt-dlp. Which backend goes first
+    # is up to backend_stats; pytubefix needs no cookies, so it stays in the race even when
+    # yt-dlp has cached metadata for the video.
+    # Above PYTUBEFIX_MAX_HEIGHT it could only fetch a lower quality, so it is not scheduled
+    # at all (an attempt that cannot deliver would count as a failure in backend_stats).
+    is_youtube = 'youtube.com' in url or 'youtu.be' in url
+    if (is_youtube and download_type == 'video' and not is_clip(start, end)
+            and (not quality or quality <= PYTUBEFIX_MAX_HEIGHT)):
+        for client in PYTUBEFIX_CLIENTS:
+            backends[f'pytubefix-{client.lower()}'] = (
+                lambda attempt, client=client: download_with_pytubefix_limited(
+                    url, download_type, quality, os.path.join(work_dir, attempt.name), client, attempt, progress))
+
+    progress.stage('extract')
+    order = backend_stats.order(list(backends))
+    _, filepath = run_hedged([(name, backends[name]) for name in order], backend_stats)
+    if not filepath:
+        raise DownloadError('All download methods failed')
+    return filepath
+
+def download_pytubefix_stream(stream, output_dir, on_progress=None):
+    """Fetch a pytubefix stream in parallel byte ranges; pytubefix's own download is the fallback"""
+    # SABR streams are not plain files and only pytubefix can fetch them
+    if getattr(stream, 'is_sabr', False):
+        return stream.download(output_path=output_dir)
+
+    filepath = stream.get_file_path(output_path=output_dir)
+    total = stream.filesize
+
+    def report(downloaded, size):
+        if on_progress:
+            on_progress(stream, b'', (size or total) - downloaded)
+
+    try:
+        return segmented.download(stream.url, filepath, headers=PYTUBEFIX_HEADERS, on_progress=report)
+    except Cancelled:
+        raise
+    except Exception as e:
+        log.info("Segmented download failed (%s), retrying over one connection", e)
+        return stream.download(output_path=output_dir, skip_existing=False)
+
+def download_with_pytubefix_limited(url, download_type, quality, output_dir, client, attempt, progress):
+    """download_with_pytubefix within the pytubefix rate limit; None on failure"""
+    try:
+        rate_limiter.acquire(PYTUBEFIX_IDENTITY)
+    except RateLimited as e:
+        log.warning("Skipping pytubefix: %s", e)
+        return None
+
+    def on_progress(stream, chunk, bytes_remaining):
+        attempt.progress()
+        progress.pytubefix_callback(stream, chunk, bytes_remaining)
+
+    started = time.time()
+    filepath = download_with_pytubefix(url, download_type, quality, output_dir, client, on_progress)
+    if filepath and os.path.exists(filepath) and os.path.getsize(filepath) > 1000:
+        log.info("pytubefix (%s) downloaded %s", client, os.path.basename(filepath))
+        metrics.STAGE_SECONDS.observe(time.time() - started, stage='download')
+        metrics.UPSTREAM_BYTES.inc(os.path.getsize(filepath), backend=attempt.name)
+        report_upstream(PYTUBEFIX_IDENTITY)
+        return filepath
+    log.info("pytubefix (%s) failed", client)
+    return None
+
+def download_with_ytdlp(url, download_type, quality, output_dir, attempt, audio_format=None, progress=None,
+                        start=None, end=None):
+    """Download with yt-dlp into output_dir. Returns the file path"""
+    import yt_dlp
+
+    base_opts = get_ydl_opts()
+    identity = egress_identity(base_opts)
+
+    try:
+        ydl_opts = dict(base_opts)
+        ydl_opts['outtmpl'] = os.path.join(output_dir, '%(title)s.%(ext)s')
+        if is_clip(start, end):
+            # Only the fragments/byte ranges covering the range are fetched. Cuts are
+            # stream copies at the nearest keyframes (force_keyframes_at_cuts would
+            # re-encode), so nothing is decoded unless MP3 was requested.
+            ydl_opts['download_ranges'] = yt_dlp.utils.download_range_func(
+                None, [(start or 0, end if end is not None else float('inf'))])
+            ydl_opts['outtmpl'] = os.path.join(output_dir, f"%(title)s ({clip_label(start, end)}).%(ext)s")
+            log.info("yt-dlp: clip %s", clip_label(start, end))
+        ydl_opts['progress_hooks'] = [attempt.progress, progress.ytdlp_hook, ytdlp_transfer_metrics]
+        ydl_opts['postprocessor_hooks'] = [progress.ytdlp_postprocessor_hook]
+
+        if download_type == 'audio' and audio_format == 'mp3':
+            # Download best audio and convert to MP3 (only when explicitly requested)
             ydl_opts['format'] = 'bestaudio/best'
             ydl_opts['postprocessors'] = [{
                 'key': 'FFmpegExtractAudio',
@@ -411,7 +662,17 @@ def download_video():
             }]
             # Ensure we keep video/audio files after processing
             ydl_opts['keepvideo'] = False
-            print(f"yt-dlp audio format: bestaudio, will convert to MP3 at {quality}kbps")
+            log.info("yt-dlp: bestaudio, converting to MP3 at %skbps", quality)
+        elif download_type == 'audio':
+            # Native audio stream as-is (m4a preferred, at most the requested bitrate).
+            # 'best' leaves m4a/opus/mp3 files untouched and only stream-copies other
+            # containers (e.g. webm -> opus), so nothing is decoded or re-encoded.
+            ydl_opts['format'] = native_audio_selector(quality)
+            ydl_opts['postprocessors'] = [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'best',
+            }]
+            log.info("yt-dlp: %s, no transcoding", ydl_opts['format'])
         else:
             # Download video based on quality setting
             if quality:
@@ -422,67 +683,584 @@ def download_video():
                 ydl_opts['format'] = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
 
             ydl_opts['merge_output_format'] = 'mp4'
-            print(f"yt-dlp video format: height<={quality}p, will merge to MP4")
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-
-            downloaded_files = os.listdir(DOWNLOAD_FOLDER)
-            if downloaded_files:
-                files_with_time = [(f, os.path.getctime(os.path.join(DOWNLOAD_FOLDER, f))) for f in downloaded_files]
-                files_with_time.sort(key=lambda x: x[1], reverse=True)
-                filename = files_with_time[0][0]
-                filepath = os.path.join(DOWNLOAD_FOLDER, filename)
-
-                if os.path.getsize(filepath) > 0:
-                    print(f"SUCCESS: yt-dlp downloaded {filename}")
-                    return send_file(
-                        filepath,
-                        as_attachment=True,
-                        download_name=filename
-                    )
+            log.info("yt-dlp: video up to %sp, merging to MP4", quality)
+
+        postprocess_pool.apply(ydl_opts)
+        # Extraction on the identity's pooled instance, the download on a per-request one
+        # with this download's options, sharing the pooled cookies and connections
+        with ydl_pool.borrow(base_opts) as extractor:
+            ydl = postprocess_pool.attach(ydl_pool.downloader(extractor, ydl_opts))
+            info = extract_info_cached(extractor, url)
+            # More parallel fragments (DASH/HLS) for bigger files
+            ydl.params['concurrent_fragment_downloads'] = segmented.connections_for(
+                estimated_size(info, download_type, quality))
+            rate_limiter.acquire(identity)
+            info = ydl.process_ie_result(info, download=True)
+            filepath = ydl_output_path(ydl, info)
+
+            if filepath and os.path.exists(filepath) and os.path.getsize(filepath) > 0:
+                log.info("yt-dlp downloaded %s", os.path.basename(filepath))
+                report_upstream(identity)
+                return filepath
+
+    except RateLimited as e:
+        raise DownloadError(str(e))
+    except Cancelled:
+        raise
+    except Exception as e:
+        if attempt.cancelled.is_set():
+            raise Cancelled(str(e))
+        log.warning("yt-dlp error: %s", e)
+        # ffmpeg failures are local and say nothing about the identity's health
+        if 'Postprocessing:' not in str(e):
+            report_upstream(identity, e)
+        raise DownloadError(f'Download failed: {str(e)}')
+
+    raise DownloadError('All download methods failed')
+
+def ytdlp_transfer_metrics(d):
+    """yt-dlp progress_hooks entry recording download time and bytes"""
+    if d.get('status') != 'finished':
+        return
+    if d.get('elapsed') is not None:
+        metrics.STAGE_SECONDS.observe(d['elapsed'], stage='download')
+    size = d.get('total_bytes') or d.get('downloaded_bytes')
+    if size:
+        metrics.UPSTREAM_BYTES.inc(size, backend='yt-dlp')
+
+def estimated_size(info, download_type, quality=None):
+    """Size in bytes of the largest format a download could pick (0 if unknown)"""
+    audio = download_type == 'audio'
+    sizes = [f.get('filesize') or f.get('filesize_approx') or 0 for f in info.get('formats') or [info]
+             if (f.get('vcodec') == 'none') == audio and (audio or not quality or (f.get('height') or 0) <= quality)]
+    return max(sizes, default=0)
+
+def native_audio_selector(quality=None):
+    """yt-dlp format selector for the best native audio up to quality kbps"""
+    if not quality:
+        return 'bestaudio[ext=m4a]/bestaudio/best'
+    return (f'bestaudio[ext=m4a][abr<={quality}]/bestaudio[abr<={quality}]/'
+            'bestaudio[ext=m4a]/bestaudio/best')
+
+def ydl_output_path(ydl, info):
+    """Final file path yt-dlp wrote (after merging/post-processing)"""
+    downloads = info.get('requested_downloads') or []
+    if downloads and downloads[-1].get('filepath'):
+        return downloads[-1]['filepath']
+    return ydl.prepare_filename(info)
+
+job_queue = JobQueue(perform_download, os.path.join(DOWNLOAD_FOLDER, 'jobs'), WORK_FOLDER)
+
+def collect_queue_metrics():
+    """Set queue and cache gauges just before a metrics snapshot"""
+    metrics.JOB_QUEUE_DEPTH.set(job_queue.depth())
+    postprocessing = postprocess_pool.stats()
+    metrics.POSTPROCESS_WAITING.set(postprocessing['waiting'])
+    metrics.POSTPROCESS_RUNNING.set(postprocessing['running'])
+    metrics.CACHE_BYTES.set(result_cache.stats()['bytes'])
+
+metrics.add_collector(collect_queue_metrics)
+
+@bp.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@bp.after_app_request
+def record_request_metrics(response):
+    """Time to build the response (streamed bodies are timed by their own stage)"""
+    endpoint = request.endpoint or 'unmatched'
+    started = g.get('request_started')
+    if started is not None:
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+    metrics.RESPONSES.inc(endpoint=endpoint, status=response.status_code)
+    if response.content_length and request.method != 'HEAD':
+        metrics.RESPONSE_BYTES.inc(response.content_length, endpoint=endpoint)
+    return response
+
+def parse_timestamp(value):
+    """Seconds from a number or [[h:]m:]s string; None for empty. Raises ValueError"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        raise ValueError(value)
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    else:
+        parts = str(value).strip().split(':')
+        if len(parts) > 3:
+            raise ValueError(value)
+        seconds = 0.0
+        for part in parts:
+            seconds = seconds * 60 + float(part)
+    if not 0 <= seconds < float('inf'):
+        raise ValueError(value)
+    return seconds
+
+def parse_quality(value):
+    """Quality as an int (max height for video, max kbps for audio); None for empty. Raises ValueError"""
+    if value is None or value == '':
+        return None
+    try:
+        if isinstance(value, bool):
+            raise ValueError(value)
+        quality = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('quality must be a whole number, e.g. 720')
+    if quality <= 0:
+        raise ValueError('quality must be a whole number, e.g. 720')
+    return quality
+
+def parse_download_request():
+    """Read url/type/quality and an optional start/end clip from the JSON body
+
+    Raises ValueError with a message for the client if quality or start/end are invalid.
+    """
+    data = request.get_json() or {}
+    quality = parse_quality(data.get('quality'))
+    try:
+        start = parse_timestamp(data.get('start'))
+        end = parse_timestamp(data.get('end'))
+    except ValueError:
+        raise ValueError('start and end must be seconds or [[h:]m:]s')
+    if end is not None and end <= (start or 0):
+        raise ValueError('end must be after start')
+    return {
+        'url': data.get('url'),
+        'download_type': data.get('type', 'video'),
+        'quality': quality,
+        'audio_format': data.get('audio_format', 'original'),
+        'start': start or None,
+        'end': end,
+    }
+
+def send_file_then(cleanup, filepath, download_name):
+    """send_file as an attachment, calling cleanup after the body has been sent
+
+    The file wrapper is handed to the server untouched, so gunicorn can send it
+    with sendfile(). Direct passthrough responses skip Response.close, so the
+    server closing the wrapper is what runs the call_on_close callbacks.
+    """
+    response = send_file(filepath, as_attachment=True, download_name=download_name)
+    started = time.perf_counter()
+
+    @response.call_on_close
+    def finish():
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - started, stage='send')
+        cleanup()
+
+    wrapper = response.response
+    close_file = wrapper.close
+
+    def close():
+        # Response.close closes the file itself, then runs the callbacks
+        wrapper.close = close_file
+        response.close()
+
+    wrapper.close = close
+    return response
+
+@bp.route('/api/download', methods=['POST'])
+def download_video():
+    """Download video/audio synchronously (kept for API clients; the page uses /api/jobs)"""
+    try:
+        params = parse_download_request()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if not params['url']:
+        return jsonify({'error': 'URL is required'}), 400
+    if params['audio_format'] not in AUDIO_FORMATS:
+        return jsonify({'error': f"audio_format must be one of {', '.join(AUDIO_FORMATS)}"}), 400
+
+    # Orphans of killed requests would otherwise pile up
+    sweep_stale(WORK_FOLDER, time.time() - JOB_TTL)
+    sweep_stale(LOCK_FOLDER, time.time() - JOB_TTL)
+
+    work_dir = os.path.join(WORK_FOLDER, uuid.uuid4().hex)
+    os.makedirs(work_dir)
+
+    try:
+        filepath = perform_download(work_dir=work_dir, **params)
+    except DownloadError as e:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return jsonify({'error': str(e)}), 500
+
+    # Remove the scratch directory once the file has been streamed
+    return send_file_then(
+        lambda: shutil.rmtree(work_dir, ignore_errors=True),
+        os.path.abspath(filepath),
+        download_name=os.path.basename(filepath)
+    )
+
+def expand_playlist(url):
+    """Video URLs of a playlist (flat extraction, one request), or [url] for a single video"""
+    ydl_opts = get_ydl_opts()
+    identity = egress_identity(ydl_opts)
+
+    rate_limiter.acquire(identity)
+    try:
+        with ydl_pool.borrow(ydl_opts, extract_flat='in_playlist', playlistend=BATCH_MAX_ITEMS) as ydl:
+            info = extract_executor.submit(ydl.extract_info, url, download=False).result()
+    except Exception as e:
+        report_upstream(identity, e)
+        raise
+    report_upstream(identity)
+
+    if info.get('_type') not in ('playlist', 'multi_video'):
+        return [url]
+    return [e.get('webpage_url') or e.get('url') for e in info.get('entries') or []
+            if e and (e.get('webpage_url') or e.get('url'))]
+
+@bp.route('/api/batch', methods=['POST'])
+def batch_download():
+    """Download several URLs or a playlist as one ZIP, streamed as items finish
+
+    Body: {"urls": [...]} or {"url": "<playlist>"}, plus type, quality and audio_format.
+    Items that fail are listed in errors.txt inside the archive.
+    """
+    data = request.get_json() or {}
+    download_type = data.get('type', 'video')
+    audio_format = data.get('audio_format', 'original')
+    try:
+        quality = parse_quality(data.get('quality'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if audio_format not in AUDIO_FORMATS:
+        return jsonify({'error': f"audio_format must be one of {', '.join(AUDIO_FORMATS)}"}), 400
+
+    urls = [u for u in data.get('urls') or [] if isinstance(u, str) and u.strip()]
+    if not urls and data.get('url'):
+        try:
+            urls = expand_playlist(data['url'])
+        except RateLimited as e:
+            return jsonify({'error': str(e)}), 503, {'Retry-After': str(JOB_RETRY_AFTER)}
+        except Exception as e:
+            return jsonify({'error': f'Could not read playlist: {str(e)}'}), 500
+
+    if not urls:
+        return jsonify({'error': 'URLs are required'}), 400
+    if len(urls) > BATCH_MAX_ITEMS:
+        return jsonify({'error': f'At most {BATCH_MAX_ITEMS} items per batch'}), 400
+
+    sweep_stale(WORK_FOLDER, time.time() - JOB_TTL)
+    sweep_stale(LOCK_FOLDER, time.time() - JOB_TTL)
+    batch_dir = os.path.join(WORK_FOLDER, uuid.uuid4().hex)
+
+    def fetch(item):
+        index, url = item
+        work_dir = os.path.join(batch_dir, str(index))
+        os.makedirs(work_dir)
+        return perform_download(url, download_type, quality, work_dir=work_dir, audio_format=audio_format)
+
+    def entries():
+        errors = []
+        for (index, url), filepath, error in run_windowed(fetch, enumerate(urls)):
+            if error:
+                log.warning("Batch item failed: %s: %s", url, error)
+                errors.append(f'{url}\t{error}')
+                continue
+            yield os.path.basename(filepath), filepath
+            # Scratch files of this item are no longer needed (cached copies stay)
+            shutil.rmtree(os.path.join(batch_dir, str(index)), ignore_errors=True)
+        if errors:
+            yield 'errors.txt', '\n'.join(errors).encode('utf-8') + b'\n'
+
+    body = ClosingIterator(zip_stream(entries()), lambda: shutil.rmtree(batch_dir, ignore_errors=True))
+    return current_app.response_class(body, mimetype='application/zip', headers={
+        'Content-Disposition': attachment_header(f'batch-{len(urls)}-items.zip'),
+        'Cache-Control': 'no-store',
+    })
+
+def signed_file_url(key):
+    """Signed, expiring URL of a cached file, or None if it is not in the cache"""
+    if not result_cache.get(key):
+        return None
+    return url_signer.sign(f'/api/files/{key}')
+
+def job_status(job):
+    """Public view of a job record"""
+    status = {
+        'job_id': job['id'],
+        'status': job['status'],
+        'filename': job.get('filename'),
+        'error': job.get('error'),
+        'status_url': f"/api/jobs/{job['id']}",
+        'events_url': f"/api/jobs/{job['id']}/events",
+        'result_url': f"/api/jobs/{job['id']}/file",
+        'download_url': None,
+        'progress': job_queue.progress(job['id']) if job['status'] == 'running' else None,
+    }
+    if job['status'] == 'done':
+        params = job['params']
+        status['download_url'] = signed_file_url(
+            result_key(params['url'], params['download_type'], params['quality'], params.get('audio_format'),
+                       params.get('start'), params.get('end')))
+    return status
+
+@bp.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """Queue a download and return its job id immediately"""
+    try:
+        params = parse_download_request()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if not params['url']:
+        return jsonify({'error': 'URL is required'}), 400
+    if params['audio_format'] not in AUDIO_FORMATS:
+        return jsonify({'error': f"audio_format must be one of {', '.join(AUDIO_FORMATS)}"}), 400
+
+    try:
+        key = result_key(**params)
+        job = job_queue.submit(params, key=key)
+    except QueueFull as e:
+        response = jsonify({'error': str(e)})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(JOB_RETRY_AFTER)
+        return response
+
+    return jsonify(job_status(job)), 202
+
+@bp.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Poll the status of a queued download"""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Unknown job'}), 404
+
+    return jsonify(job_status(job))
+
+def sse(event, data):
+    """One Server-Sent Events message"""
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+@bp.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Server-Sent Events with a job's progress, ending with a done or failed event
+
+    The job's files are only re-read when their mtimes change. Streams end after
+    SSE_MAX_DURATION seconds so no connection is held for a whole download;
+    EventSource reconnects on its own and picks up the current state.
+    """
+    if not job_queue.get(job_id):
+        return jsonify({'error': 'Unknown job'}), 404
+
+    def events():
+        yield f'retry: {SSE_RETRY_MS}\n\n'
+        deadline = time.time() + SSE_MAX_DURATION
+        last_signature = None
+        last_message = time.time()
+
+        while time.time() < deadline:
+            signature = job_queue.signature(job_id)
+            if signature != last_signature:
+                last_signature = signature
+                job = job_queue.get(job_id)
+                if not job:
+                    yield sse('failed', {'error': 'Unknown job'})
+                    return
+                if job['status'] == 'done':
+                    yield sse('done', job_status(job))
+                    return
+                if job['status'] == 'error':
+                    yield sse('failed', job_status(job))
+                    return
+                yield sse('progress', job_queue.progress(job_id) or {'stage': job['status']})
+                last_message = time.time()
+            elif time.time() - last_message >= SSE_KEEPALIVE:
+                # Comment line keeps proxies from closing an idle stream
+                yield ': keepalive\n\n'
+                last_message = time.time()
+            time.sleep(SSE_POLL_INTERVAL)
+
+    return current_app.response_class(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+@bp.route('/api/jobs/<job_id>/file', methods=['GET'])
+def get_job_file(job_id):
+    """Fetch the finished file of a download job"""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Unknown job'}), 404
+
+    if job['status'] == 'error':
+        return jsonify({'error': job['error']}), 500
+
+    if job['status'] != 'done':
+        response = jsonify(job_status(job))
+        response.status_code = 409
+        response.headers['Retry-After'] = '2'
+        return response
+
+    if not os.path.exists(job['filepath']):
+        return jsonify({'error': 'File is no longer available'}), 410
+
+    # The job's scratch directory is only needed until the file has been streamed.
+    # Shared jobs keep it until JOB_TTL so every requester can fetch the file.
+    return send_file_then(
+        lambda: None if job.get('shared') else job_queue.cleanup(job_id),
+        job['filepath'],
+        download_name=job['filename']
+    )
+
+@bp.route('/api/files/<key>', methods=['GET', 'HEAD'])
+def get_signed_file(key):
+    """Serve a cached file from a signed URL (see job_status), with Range and conditional GET
+
+    Browsers can download these natively and resume an interrupted download.
+    """
+    if not url_signer.verify(request.path, request.args.get('expires'), request.args.get('sig')):
+        return jsonify({'error': 'Link is invalid or has expired'}), 403
+
+    filepath = result_cache.get(key)
+    if not filepath:
+        return jsonify({'error': 'File is no longer available'}), 410
+
+    response = send_file(filepath, as_attachment=True, download_name=os.path.basename(filepath),
+                         conditional=True, etag=True)
+    response.headers['Cache-Control'] = 'private, max-age=0'
+    return response
+
+def attachment_header(filename):
+    """Content-Disposition for a download, with an RFC 5987 name for non-ASCII titles"""
+    ascii_name = filename.encode('ascii', 'ignore').decode().replace('"', '') or 'download'
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+
+@bp.route('/api/stream', methods=['GET', 'HEAD'])
+def stream_download():
+    """Stream a single-file format to the client while it downloads
+
+    Query: url, type (video/audio), quality. Cached results are sent from disk.
+    HEAD answers 200 if the request can be streamed or served from cache and
+    409 if it needs a merge/transcode (use /api/jobs instead).
+    """
+    import yt_dlp
+
+    url = request.args.get('url')
+    download_type = request.args.get('type', 'video')
+    quality = request.args.get('quality', type=int)
+    audio_format = request.args.get('audio_format', 'original')
 
+    if not url:
+        return jsonify({'error': 'URL is required'}), 400
+
+    # A finished download (merged or transcoded) is as good as a stream
+    stream_key = cache_key(url, f'{download_type}-stream', quality)
+    keys = [result_key(url, download_type, quality, audio_format)]
+    if audio_format != 'mp3':
+        keys.append(stream_key)
+    for key in keys:
+        cached = result_cache.get(key)
+        if cached:
+            log.info("Cache hit: %s", os.path.basename(cached))
+            return send_file(cached, as_attachment=True, download_name=os.path.basename(cached))
+
+    try:
+        ydl_opts = get_ydl_opts()
+        with ydl_pool.borrow(ydl_opts) as ydl:
+            info = extract_info_cached(ydl, url)
     except Exception as e:
-        print(f"YT-DLP ERROR: {str(e)}")
-        return jsonify({'error': f'Download failed: {str(e)}'}), 500
+        return jsonify({'error': str(e)}), 500
+
+    fmt = None if audio_format == 'mp3' else select_stream_format(info, download_type, quality)
+    if not fmt:
+        return jsonify({'error': 'This format cannot be streamed, use /api/jobs'}), 409
+
+    filename = f"{yt_dlp.utils.sanitize_filename(info.get('title') or 'download')}.{fmt.get('ext', 'mp4')}"
+    headers = {
+        'Content-Disposition': attachment_header(filename),
+        'Content-Type': mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+    }
+    filesize = fmt.get('filesize') or fmt.get('filesize_approx')
 
-    return jsonify({'error': 'All download methods failed'}), 500
+    if request.method == 'HEAD':
+        response = current_app.response_class(headers=headers)
+        if fmt.get('filesize'):
+            # Set after the (empty) body, which would otherwise make it 0
+            response.content_length = fmt['filesize']
+        return response
 
-@app.route('/')
+    identity = egress_identity(ydl_opts)
+    try:
+        rate_limiter.acquire(identity)
+        upstream = open_upstream(fmt, ydl_opts.get('proxy'))
+    except RateLimited as e:
+        response = jsonify({'error': str(e)})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(JOB_RETRY_AFTER)
+        return response
+    except Exception as e:
+        report_upstream(identity, e)
+        return jsonify({'error': f'Download failed: {str(e)}'}), 502
+    report_upstream(identity)
+
+    if upstream.headers.get('Content-Length'):
+        headers['Content-Length'] = upstream.headers['Content-Length']
+
+    # Tee to disk only when the result cache has room for the file
+    work_dir = None
+    tee_path = None
+    if result_cache.enabled and (not filesize or filesize <= result_cache.max_bytes):
+        work_dir = os.path.join(WORK_FOLDER, uuid.uuid4().hex)
+        os.makedirs(work_dir)
+        tee_path = os.path.join(work_dir, filename)
+
+    log.info("Streaming %s (%s, %s) for %s", fmt.get('format_id'), fmt.get('ext'), fmt.get('height') or fmt.get('abr'), url)
+    body = relay(upstream, tee_path, on_complete=lambda path: result_cache.put(stream_key, path))
+    started = time.perf_counter()
+    body = ClosingIterator(body, lambda: metrics.STAGE_SECONDS.observe(time.perf_counter() - started, stage='stream'))
+    if work_dir:
+        body = ClosingIterator(body, lambda: shutil.rmtree(work_dir, ignore_errors=True))
+
+    return current_app.response_class(body, headers=headers)
+
+@bp.route('/')
 def index():
     """Serve the main page"""
-    return send_file('index.html')
+    return static_assets.response('index.html')
 
-@app.route('/privacy')
+@bp.route('/privacy')
 def privacy():
     """Serve the privacy policy page"""
-    return send_file('privacy.html')
+    return static_assets.response('privacy.html')
 
-@app.route('/terms')
+@bp.route('/terms')
 def terms():
     """Serve the terms of use page"""
-    return send_file('terms.html')
+    return static_assets.response('terms.html')
 
-@app.route('/contact')
+@bp.route('/contact')
 def contact():
     """Serve the contact page"""
-    return send_file('contact.html')
+    return static_assets.response('contact.html')
 
-@app.route('/sitemap.xml')
+@bp.route('/sitemap.xml')
 def sitemap():
     """Serve sitemap for search engines"""
-    response = send_file('sitemap.xml')
-    response.headers['Content-Type'] = 'application/xml; charset=utf-8'
-    return response
+    return static_assets.response('sitemap.xml')
 
-@app.route('/robots.txt')
+@bp.route('/robots.txt')
 def robots():
     """Serve robots.txt for search engines"""
-    response = send_file('robots.txt')
-    response.headers['Content-Type'] = 'text/plain'
-    return response
-
-@app.route('/api/health', methods=['GET'])
+    return static_assets.response('robots.txt')
+
+@bp.route('/assets/<name>')
+def fingerprinted_asset(name):
+    """Serve a content-hashed asset (cached immutably)"""
+    if not static_assets.get(f'assets/{name}'):
+        return jsonify({'error': 'Not found'}), 404
+    return static_assets.response(f'assets/{name}')
+
+@bp.route('/<name>')
+def static_asset(name):
+    """Serve style.css, script.js and logo.png under their plain names"""
+    if name not in FINGERPRINTED:
+        return jsonify({'error': 'Not found'}), 404
+    return static_assets.response(name)
+
+@bp.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint with cookie status"""
     import glob
@@ -500,90 +1278,73 @@ def health_check():
     return jsonify({
         'status': 'ok',
         'cookies_found': len(cookie_files),
-        'cookies': cookie_status
+        'cookies': cookie_status,
+        'jobs_queued': job_queue.depth(),
+        'cache': result_cache.stats(),
+        'rate_limits': rate_limiter.stats(),
+        'identities': identity_pool.stats(),
+        'backends': backend_stats.stats(),
+        'postprocessing': postprocess_pool.stats(),
+        'extractors': ydl_pool.stats()
     })
 
-@app.route('/api/donations', methods=['GET'])
-def get_donations():
-    """Get current donation progress from Ko-fi"""
-    try:
-        # Try to fetch from Ko-fi page
-        kofi_url = 'https://ko-fi.com/universalvideodownloader/goal?g=0'
-
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-        }
-
-        response = requests.get(kofi_url, headers=headers, timeout=5)
-
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
-
-            # Try to find goal progress in the page
-            # Ko-fi typically has progress data in their goal widget
-            # Look for percentage or progress indicators
-
-            # Try to find progress percentage
-            progress_elements = soup.find_all(['div', 'span'], class_=lambda x: x and 'progress' in x.lower())
-
-            for element in progress_elements:
-                text = element.get_text().strip()
-                if '%' in text:
-                    # Extract percentage
-                    percentage = int(''.join(filter(str.isdigit, text)))
-                    if 0 <= percentage <= 100:
-                        return jsonify({'percentage': percentage})
-
-            # Try to find goal amounts
-            amounts = soup.find_all(string=lambda text: text and '$' in str(text))
-            for amount_text in amounts:
-                # Look for patterns like "$150 / $500" or "$150 of $500"
-                if '/' in amount_text or ' of ' in amount_text:
-                    try:
-                        parts = amount_text.replace('$', '').replace(',', '')
-                        if '/' in parts:
-                            current, goal = parts.split('/')
-                        else:
-                            current, goal = parts.split(' of ')
-
-                        current = float(current.strip())
-                        goal = float(goal.strip())
-
-                        if goal > 0:
-                            percentage = min(int((current / goal) * 100), 100)
-                            return jsonify({'percentage': percentage})
-                    except:
-                        continue
-
-        # Fallback to local file if Ko-fi fetch fails
-        donations_file = os.path.join(os.path.dirname(__file__), 'donations.json')
-        if os.path.exists(donations_file):
-            with open(donations_file, 'r') as f:
-                data = json.load(f)
-                current = data.get('current', 0)
-                goal = data.get('goal', 500)
-                percentage = min(int((current / goal) * 100), 100) if goal > 0 else 0
-                return jsonify({'percentage': percentage})
-
-        return jsonify({'percentage': 0})
+@bp.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics, merged across all workers on this host"""
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
-    except Exception as e:
-        print(f"Error fetching donations: {e}")
-        # Fallback to local file
-        try:
-            donations_file = os.path.join(os.path.dirname(__file__), 'donations.json')
-            if os.path.exists(donations_file):
-                with open(donations_file, 'r') as f:
-                    data = json.load(f)
-                    current = data.get('current', 0)
-                    goal = data.get('goal', 500)
-                    percentage = min(int((current / goal) * 100), 100) if goal > 0 else 0
-                    return jsonify({'percentage': percentage})
-        except:
-            pass
-
-        return jsonify({'percentage': 0})
+@bp.route('/api/donations', methods=['GET'])
+def get_donations():
+    """Get current donation progress (Ko-fi, refreshed in the background)"""
+    response = jsonify({'percentage': donation_progress.percentage()})
+
+    # Every open tab polls this; let browsers reuse or revalidate their copy
+    response.headers['Cache-Control'] = f'public, max-age={DONATIONS_MAX_AGE}'
+    response.set_etag(hashlib.md5(response.get_data()).hexdigest())
+    return response.make_conditional(request)
+
+def preload_extractors():
+    """Import the extractor stack now, reporting how long each module takes"""
+    for name in HEAVY_MODULES:
+        if name in sys.modules:
+            continue
+        started = time.perf_counter()
+        __import__(name)
+        log.info("Imported %s in %.0f ms", name, (time.perf_counter() - started) * 1000)
+
+def start_background_tasks():
+    """Start per-process background threads (call after forking, once per worker)"""
+    # Auto-update cookies from cnvmp3.com (one refresher per host, COOKIE_REFRESH_INTERVAL
+    # seconds apart); workers reload cookies*.txt when it changes
+    start_refresher()
+    donation_progress.start_refresher()
+    metrics.start_flusher()
+
+def create_app():
+    """Build the Flask app
+
+    Background threads are not started here because with gunicorn's preload_app
+    this runs in the master; gunicorn.conf.py starts them in each worker.
+    """
+    # Static files come from the asset pipeline, so only the site's own assets are public
+    app = Flask(__name__, static_folder=None)
+    if TRUSTED_PROXIES > 0:
+        # remote_addr becomes the client's address instead of the proxy's
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+    CORS(app)
+    app.register_blueprint(bp)
+
+    if os.environ.get('PRELOAD_EXTRACTORS', 'False') == 'True':
+        preload_extractors()
+
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+    log.info("App ready in %.0f ms (extractor stack %s)", (time.perf_counter() - BOOT_STARTED) * 1000,
+             'loaded: ' + ', '.join(loaded) if loaded else 'not loaded yet')
+    return app
+
+app = create_app()
 
 if __name__ == '__main__':
+    start_background_tasks()
     port = int(os.environ.get('PORT', 5000))
     app.run(debug=os.environ.get('DEBUG', 'False') == 'True', host='0.0.0.0', port=port)
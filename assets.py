@@ -0,0 +1,157 @@
+"""
+Static asset pipeline
+Pages, styles, scripts and images are read once at startup, compressed
+(gzip, and brotli when the package is installed) and hashed. Responses are
+picked by Accept-Encoding, carry strong ETags and answer conditional GETs.
+style.css, script.js and logo.png also get content-hashed URLs that the
+pages link to, so browsers can cache them forever.
+"""
+
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+# Everything the site serves from the repository folder; nothing else is public
+PAGES = ('index.html', 'privacy.html', 'terms.html', 'contact.html', 'sitemap.xml', 'robots.txt')
+FINGERPRINTED = ('style.css', 'script.js', 'logo.png')
+
+CONTENT_TYPES = {
+    'sitemap.xml': 'application/xml; charset=utf-8',
+    'robots.txt': 'text/plain',
+}
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/xml', 'image/svg+xml')
+MIN_COMPRESS_SIZE = 512
+
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE = 'no-cache'  # always revalidate, usually answered with 304
+SHORT_CACHE = 'public, max-age=300'  # unversioned asset URLs, e.g. from old cached pages
+
+# (header value, file suffix) in order of preference
+ENCODINGS = (('br', 'br'), ('gzip', 'gz'))
+
+
+class Asset:
+    """One file with its precomputed encodings"""
+
+    def __init__(self, name, data, content_type, cache_control):
+        self.name = name
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.variants = {'identity': data}
+
+        if content_type.startswith(COMPRESSIBLE) and len(data) >= MIN_COMPRESS_SIZE:
+            gzipped = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(gzipped) < len(data):
+                self.variants['gzip'] = gzipped
+            if brotli is not None:
+                brotlied = brotli.compress(data, quality=11)
+                if len(brotlied) < len(data):
+                    self.variants['br'] = brotlied
+
+    def etag(self, encoding):
+        # Strong ETags must differ between encodings of the same content
+        suffix = dict(ENCODINGS).get(encoding)
+        return f'{self.digest[:32]}-{suffix}' if suffix else self.digest[:32]
+
+
+def accepted_encoding(accept_encoding, available):
+    """Best encoding from an Accept-Encoding header that we have a variant for"""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        token, _, params = part.strip().partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0
+        accepted[token.strip().lower()] = q
+    for encoding, _ in ENCODINGS:
+        if encoding in available and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return 'identity'
+
+
+class AssetPipeline:
+    """Build-once store of the site's static files"""
+
+    def __init__(self, root):
+        self.root = root
+        self.assets = {}
+        self.urls = {}  # plain name -> fingerprinted URL
+        self.build()
+
+    def _read(self, name):
+        with open(os.path.join(self.root, name), 'rb') as f:
+            return f.read()
+
+    def _content_type(self, name):
+        if name in CONTENT_TYPES:
+            return CONTENT_TYPES[name]
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type == 'application/javascript':
+            content_type += '; charset=utf-8'
+        return content_type
+
+    def build(self):
+        """Read, fingerprint and compress every asset"""
+        assets, urls = {}, {}
+
+        for name in FINGERPRINTED:
+            data = self._read(name)
+            content_type = self._content_type(name)
+            asset = Asset(name, data, content_type, SHORT_CACHE)
+            stem, ext = os.path.splitext(name)
+            hashed_name = f'{stem}.{asset.digest[:10]}{ext}'
+            assets[name] = asset
+            assets[f'assets/{hashed_name}'] = Asset(hashed_name, data, content_type, IMMUTABLE_CACHE)
+            urls[name] = f'/assets/{hashed_name}'
+
+        for name in PAGES:
+            data = self._read(name)
+            if name.endswith('.html'):
+                data = self.rewrite_links(data.decode('utf-8'), urls).encode('utf-8')
+            assets[name] = Asset(name, data, self._content_type(name), REVALIDATE_CACHE)
+
+        self.assets, self.urls = assets, urls
+        total = sum(len(v) for a in assets.values() for v in a.variants.values())
+        log.info("Built %d static assets (%d bytes with encodings, brotli %s)",
+                 len(assets), total, 'on' if brotli else 'off')
+
+    @staticmethod
+    def rewrite_links(html, urls):
+        """Point style.css/script.js/logo.png references at their fingerprinted URLs"""
+        for name, url in urls.items():
+            for quote in ('"', "'"):
+                for prefix in ('', '/'):
+                    html = html.replace(f'{quote}{prefix}{name}{quote}', f'{quote}{url}{quote}')
+                    html = html.replace(f'{quote}{prefix}{name}?', f'{quote}{url}?')
+        return html
+
+    def get(self, name):
+        return self.assets.get(name)
+
+    def response(self, name):
+        """Response for an asset in the client's preferred encoding, honouring If-None-Match"""
+        asset = self.assets[name]
+        encoding = accepted_encoding(request.headers.get('Accept-Encoding'), asset.variants)
+
+        response = current_app.response_class(asset.variants[encoding], content_type=asset.content_type)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = asset.cache_control
+        response.set_etag(asset.etag(encoding))
+        return response.make_conditional(request)
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+"""
+Offline load test: the app under gunicorn against a local media server
+Synthetic media files are served from a temporary directory and yt-dlp's
+extraction is stubbed to describe them (one progressive format per height plus
+video-only and audio-only formats), so the whole pipeline runs -- metadata
+cache, rate limiter, hedging, downloads, post-processing, result cache, sending --
+without touching YouTube. The stub URLs are not YouTube URLs, so every download
+goes through yt-dlp and pytubefix is never started.
+
+    python bench.py --scenario download --concurrency 8 --requests 200
+
+Reports requests/s, latency percentiles, peak RSS of the gunicorn processes and
+peak disk use of the download folder, and appends the results to
+bench_results.jsonl, comparing them with the last run of the same settings.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import urlparse, parse_qs
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_FILE = os.path.join(BASE_DIR, 'bench_results.jsonl')
+
+SAMPLE_INTERVAL = 0.5  # seconds between RSS/disk samples
+STARTUP_TIMEOUT = 60  # seconds to wait for gunicorn to answer /api/health
+
+# Synthetic formats: (format_id, ext, height, vcodec, acodec, abr, share of --media-size)
+FORMATS = (
+    ('18', 'mp4', 360, 'avc1.42001E', 'mp4a.40.2', None, 0.25),
+    ('22', 'mp4', 720, 'avc1.64001F', 'mp4a.40.2', None, 0.6),
+    ('137', 'mp4', 1080, 'avc1.640028', 'none', None, 1.0),
+    ('140', 'm4a', None, 'none', 'mp4a.40.2', 129.5, 0.1),
+    ('251', 'webm', None, 'none', 'opus', 160.0, 0.12),
+)
+
+SCENARIOS = {
+    'formats': ('/api/formats', lambda url, args: {'url': url}),
+    'download': ('/api/download', lambda url, args: {'url': url, 'type': 'video', 'quality': args.quality}),
+    'audio': ('/api/download', lambda url, args: {'url': url, 'type': 'audio'}),
+}
+
+# Settings that make two runs comparable
+COMPARED_SETTINGS = ('scenario', 'concurrency', 'requests', 'videos', 'quality', 'workers',
+                     'media_size', 'extract_delay')
+
+
+# --- Stubbed extraction (runs inside gunicorn) ---
+
+def fake_info(url, media_url):
+    """yt-dlp info dict for a bench URL like <media_url>/watch?v=<id>"""
+    video_id = parse_qs(urlparse(url).query).get('v', ['video'])[0]
+    formats = []
+    for format_id, ext, height, vcodec, acodec, abr, _ in FORMATS:
+        path = os.path.join(os.environ['BENCH_MEDIA_DIR'], f'{format_id}.{ext}')
+        formats.append({
+            'format_id': format_id,
+            'url': f'{media_url}/{format_id}.{ext}',
+            'ext': ext,
+            'protocol': 'http',
+            'height': height,
+            'width': height * 16 // 9 if height else None,
+            'vcodec': vcodec,
+            'acodec': acodec,
+            'abr': abr,
+            'fps': 30 if height else None,
+            'filesize': os.path.getsize(path),
+        })
+    return {
+        'id': video_id,
+        'title': f'Bench video {video_id}',
+        'duration': 60,
+        'webpage_url': url,
+        'extractor': 'bench',
+        'extractor_key': 'Bench',
+        'formats': formats,
+    }
+
+
+def stubbed_app():
+    """The Flask app with YoutubeDL.extract_info answering from the media server
+
+    Used as gunicorn's app ('bench:stubbed_app()'); with preload_app the stub is
+    installed in the master and inherited by every worker.
+    """
+    import yt_dlp
+
+    media_url = os.environ['BENCH_MEDIA_URL']
+    delay = float(os.environ.get('BENCH_EXTRACT_DELAY', 0))
+    extract_info = yt_dlp.YoutubeDL.extract_info
+
+    def bench_extract_info(self, url, download=True, *args, **kwargs):
+        if not url.startswith(media_url):
+            return extract_info(self, url, download, *args, **kwargs)
+        # Stand-in for the round trips of a real extraction
+        time.sleep(delay)
+        info = fake_info(url, media_url)
+        return self.process_ie_result(info, download=download) if download else info
+
+    yt_dlp.YoutubeDL.extract_info = bench_extract_info
+
+    from app import app
+    return app
+
+
+# --- Harness ---
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def write_media(directory, size):
+    """Random-content media files for FORMATS, the largest size bytes"""
+    chunk = os.urandom(1024 * 1024)
+    for format_id, ext, _, _, _, _, share in FORMATS:
+        remaining = max(1, int(size * share))
+        with open(os.path.join(directory, f'{format_id}.{ext}'), 'wb') as f:
+            while remaining > 0:
+                f.write(chunk[:remaining])
+                remaining -= len(chunk)
+
+
+def wait_until_up(url, process, timeout=STARTUP_TIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{url} exited during startup (code {process.returncode})')
+        try:
+            with urllib.request.urlopen(url, timeout=2):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'{url} did not come up within {timeout}s')
+
+
+def process_tree_rss(root_pid):
+    """Resident memory in bytes of root_pid and all its descendants (ps works on Linux and macOS)"""
+    output = subprocess.run(['ps', '-A', '-o', 'pid=,ppid=,rss='], capture_output=True, text=True).stdout
+    children = {}
+    rss = {}
+    for line in output.splitlines():
+        pid, ppid, kb = (int(x) for x in line.split())
+        children.setdefault(ppid, []).append(pid)
+        rss[pid] = kb * 1024
+    total = 0
+    stack = [root_pid]
+    while stack:
+        pid = stack.pop()
+        total += rss.get(pid, 0)
+        stack.extend(children.get(pid, []))
+    return total
+
+
+def disk_usage(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class Sampler(threading.Thread):
+    """Tracks peak RSS of the server processes and peak size of the download folder"""
+
+    def __init__(self, pid, folder):
+        super().__init__(name='bench-sampler', daemon=True)
+        self.pid = pid
+        self.folder = folder
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self.done = threading.Event()
+
+    def sample(self):
+        self.peak_rss = max(self.peak_rss, process_tree_rss(self.pid))
+        self.peak_disk = max(self.peak_disk, disk_usage(self.folder))
+
+    def run(self):
+        while not self.done.wait(SAMPLE_INTERVAL):
+            self.sample()
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        self.sample()
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def run_load(base_url, media_url, args):
+    """Send args.requests requests, args.concurrency at a time; returns one (latency, status, bytes) per request"""
+    path, payload = SCENARIOS[args.scenario]
+    counter = iter(range(args.requests))
+    lock = threading.Lock()
+    samples = []
+
+    def client():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            video = i if args.videos == 0 else i % args.videos
+            body = json.dumps(payload(f'{media_url}/watch?v=bench{video:05d}', args)).encode()
+            req = urllib.request.Request(base_url + path, data=body, headers={'Content-Type': 'application/json'})
+            started = time.perf_counter()
+            size = 0
+            try:
+                with urllib.request.urlopen(req, timeout=args.timeout) as response:
+                    status = response.status
+                    while True:
+                        chunk = response.read(256 * 1024)
+                        if not chunk:
+                            break
+                        size += len(chunk)
+            except urllib.error.HTTPError as e:
+                status = e.code
+                e.read()
+            except OSError as e:
+                status = type(e).__name__
+            with lock:
+                samples.append((time.perf_counter() - started, status, size))
+
+    threads = [threading.Thread(target=client, name=f'bench-client-{n}') for n in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples
+
+
+def summarize(samples, elapsed, sampler, args):
+    latencies = sorted(latency for latency, status, _ in samples if status == 200)
+    statuses = {}
+    for _, status, _ in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    received = sum(size for _, status, size in samples if status == 200)
+    ms = lambda value: round(value * 1000, 1) if value is not None else None
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'settings': {name: getattr(args, name) for name in COMPARED_SETTINGS},
+        'ok': len(latencies),
+        'errors': len(samples) - len(latencies),
+        'statuses': statuses,
+        'elapsed': round(elapsed, 2),
+        'rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1] if latencies else None),
+        'received_mb': round(received / 1024 ** 2, 1),
+        'peak_rss_mb': round(sampler.peak_rss / 1024 ** 2, 1),
+        'peak_disk_mb': round(sampler.peak_disk / 1024 ** 2, 1),
+    }
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BASE_DIR,
+                               capture_output=True, text=True).stdout.strip()
+        return f'{revision}-dirty' if dirty else revision
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def previous_result(path, settings):
+    """Last saved result with the same settings, or None"""
+    previous = None
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                if result.get('settings') == settings:
+                    previous = result
+    except FileNotFoundError:
+        pass
+    return previous
+
+
+def report(result, previous):
+    print(f"\n{result['settings']['scenario']}: {result['ok']} ok, {result['errors']} errors "
+          f"{result['statuses']} in {result['elapsed']}s ({result['revision']})")
+    for field in ('rps', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'peak_rss_mb', 'peak_disk_mb'):
+        line = f'  {field:<13}{result[field]}'
+        if previous and previous.get(field) and result[field] is not None:
+            change = (result[field] - previous[field]) / previous[field] * 100
+            line += f'   ({change:+.1f}% vs {previous["revision"]} at {previous["time"]})'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load test with stubbed extractors')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='download')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=100, help='total requests')
+    parser.add_argument('--videos', type=int, default=10,
+                        help='distinct video ids cycled through (cache hits after the first round); 0 = all distinct')
+    parser.add_argument('--quality', type=int, default=720, help='video height for the download scenario')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--media-size', type=float, default=5, help='size of the largest media file in MB')
+    parser.add_argument('--extract-delay', type=float, default=0.3, help='simulated extraction time in seconds')
+    parser.add_argument('--timeout', type=float, default=300, help='per-request timeout in seconds')
+    parser.add_argument('--output', default=RESULTS_FILE, help='JSON lines file results are appended to')
+    parser.add_argument('--no-save', action='store_true', help='print results without saving them')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary directory')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='videodl-bench-')
+    media_dir = os.path.join(scratch, 'media')
+    app_dir = os.path.join(scratch, 'app')
+    os.makedirs(media_dir)
+    os.makedirs(app_dir)
+    write_media(media_dir, int(args.media_size * 1024 ** 2))
+
+    media_port, app_port = free_port(), free_port()
+    media_url = f'http://127.0.0.1:{media_port}'
+    base_url = f'http://127.0.0.1:{app_port}'
+
+    env = dict(os.environ, BENCH_MEDIA_URL=media_url, BENCH_MEDIA_DIR=media_dir,
+               BENCH_EXTRACT_DELAY=str(args.extract_delay))
+    # Nothing may leave the machine: no proxies, no cookie or Ko-fi refreshes
+    for name in ('PROXIES', 'HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy'):
+        env.pop(name, None)
+    env.update(COOKIE_REFRESH_INTERVAL='0', DONATIONS_REFRESH_INTERVAL='0')
+    # The limiter protects YouTube, not the media server; set these to include it in a run
+    env.setdefault('RATELIMIT_MAX_RATE', '1000')
+    env.setdefault('RATELIMIT_BURST', '1000')
+    env.setdefault('LOG_LEVEL', 'WARNING')
+
+    media = subprocess.Popen([sys.executable, '-m', 'http.server', str(media_port), '--bind', '127.0.0.1',
+                              '--directory', media_dir], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(BASE_DIR, 'gunicorn.conf.py'),
+                               '--pythonpath', BASE_DIR, '--chdir', app_dir, '-b', f'127.0.0.1:{app_port}',
+                               '-w', str(args.workers), 'bench:stubbed_app()'], env=env)
+    try:
+        wait_until_up(f'{media_url}/', media)
+        wait_until_up(f'{base_url}/api/health', server)
+        print(f'Running {args.requests} {args.scenario} requests, {args.concurrency} at a time '
+              f'({args.workers} workers, {args.media_size} MB media)')
+
+        sampler = Sampler(server.pid, os.path.join(app_dir, 'downloads'))
+        sampler.start()
+        started = time.perf_counter()
+        samples = run_load(base_url, media_url, args)
+        elapsed = time.perf_counter() - started
+        sampler.stop()
+    finally:
+        for process in (server, media):
+            process.send_signal(signal.SIGTERM)
+        for process in (server, media):
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if args.keep:
+            print(f'Kept {scratch}')
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    result = summarize(samples, elapsed, sampler, args)
+    report(result, previous_result(args.output, result['settings']))
+    if not args.no_save:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+        print(f'Saved to {args.output}')
+    return 0 if result['ok'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,264 @@
+"""
+On-disk caches shared by all gunicorn workers
+ResultCache keeps finished downloads, keyed by canonical video id + type +
+quality and evicted LRU once it grows past its byte budget. MetadataCache
+keeps extract_info results per egress proxy until their stream URLs expire. Both are indexed
+in SQLite, so they survive restarts and are safe to share between processes.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from urllib.parse import urlparse, parse_qsl, urlencode
+
+log = logging.getLogger(__name__)
+
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 2 * 1024 ** 3))  # 0 disables the cache
+METADATA_TTL = int(os.environ.get('METADATA_TTL', 1800))  # seconds, 0 disables the cache
+METADATA_EXPIRY_MARGIN = 120  # stop serving stream URLs this long before they expire
+
+# Signed stream URLs carry their expiry as ?expire=<ts> or /expire/<ts>/
+EXPIRE_PATTERN = re.compile(r'[?&/]expire[=/](\d+)')
+
+YOUTUBE_HOSTS = {'youtube.com', 'www.youtube.com', 'm.youtube.com', 'music.youtube.com', 'youtube-nocookie.com', 'www.youtube-nocookie.com'}
+
+# Query parameters that never change which media a URL points at
+IGNORED_PARAMS = {'t', 'start', 'si', 'feature', 'pp', 'ab_channel', 'fbclid', 'igshid', 'ref', 'share_id'}
+
+
+def canonical_video_id(url):
+    """Normalize a URL so every variant of the same video maps to one id
+
+    YouTube watch/youtu.be/shorts/embed/live URLs become 'youtube:<id>'.
+    Other URLs keep host and path with tracking and timestamp parameters dropped.
+    """
+    parsed = urlparse(url.strip() if '://' in url else f'https://{url.strip()}')
+    host = (parsed.hostname or '').lower()
+    path = parsed.path.rstrip('/')
+
+    if host in YOUTUBE_HOSTS:
+        video_id = dict(parse_qsl(parsed.query)).get('v')
+        if not video_id:
+            parts = path.split('/')
+            if len(parts) >= 3 and parts[1] in ('shorts', 'embed', 'live', 'v'):
+                video_id = parts[2]
+        if video_id:
+            return f'youtube:{video_id}'
+    elif host == 'youtu.be' and path:
+        return f'youtube:{path.lstrip("/").split("/")[0]}'
+
+    if host.startswith('www.'):
+        host = host[4:]
+    query = sorted((k, v) for k, v in parse_qsl(parsed.query)
+                   if k not in IGNORED_PARAMS and not k.startswith('utm_'))
+    return f'{host}{path}' + (f'?{urlencode(query)}' if query else '')
+
+
+def cache_key(url, download_type, quality):
+    """Content address for one rendition of a video"""
+    raw = f'{canonical_video_id(url)}|{download_type}|{quality or ""}'
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def stream_url_expiry(info):
+    """Earliest expiry timestamp of the stream URLs in an info dict, or None"""
+    expiries = []
+    for f in info.get('formats') or [info]:
+        for field in ('url', 'manifest_url'):
+            match = EXPIRE_PATTERN.search(f.get(field) or '')
+            if match:
+                expiries.append(int(match.group(1)))
+    return min(expiries) if expiries else None
+
+
+class SQLiteStore:
+    """Base for caches indexed in a SQLite database"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+
+    @contextmanager
+    def _connect(self):
+        # One short-lived connection per call keeps this fork- and thread-safe
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+def egress_key(proxy):
+    """Stable key for the address requests leave from (proxy credentials are not stored)"""
+    return hashlib.sha256(proxy.encode()).hexdigest()[:16] if proxy else 'direct'
+
+
+class MetadataCache(SQLiteStore):
+    """extract_info results keyed by canonical video id and egress, expiring with their stream URLs
+
+    Stream URLs (googlevideo's ip= parameter) only work from the address that
+    extracted them, so downloads look up the entry for their own proxy;
+    get_any serves callers that only need titles and formats.
+    """
+
+    def __init__(self, db_path, ttl=METADATA_TTL):
+        super().__init__(db_path)
+        self.ttl = ttl
+        with self._connect() as db:
+            # Entries of the old table were not tied to a proxy
+            db.execute('DROP TABLE IF EXISTS metadata')
+            db.execute('''CREATE TABLE IF NOT EXISTS extractions (
+                video TEXT NOT NULL,
+                egress TEXT NOT NULL,
+                info TEXT NOT NULL,
+                expires REAL NOT NULL,
+                PRIMARY KEY (video, egress)
+            )''')
+
+    def get(self, url, proxy=None):
+        """Cached info dict for url as extracted through proxy, or None if missing or expired"""
+        if self.ttl <= 0:
+            return None
+        with self._connect() as db:
+            row = db.execute('SELECT info FROM extractions WHERE video = ? AND egress = ? AND expires > ?',
+                             (canonical_video_id(url), egress_key(proxy), time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_any(self, url):
+        """Freshest cached info dict for url from any proxy (stream URLs may not work here)"""
+        if self.ttl <= 0:
+            return None
+        with self._connect() as db:
+            row = db.execute('SELECT info FROM extractions WHERE video = ? AND expires > ? '
+                             'ORDER BY expires DESC LIMIT 1', (canonical_video_id(url), time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, url, info, proxy=None):
+        """Store a JSON-serializable info dict (use YoutubeDL.sanitize_info) extracted through proxy"""
+        if self.ttl <= 0 or info.get('_type', 'video') != 'video':
+            return
+        now = time.time()
+        expires = now + self.ttl
+        url_expiry = stream_url_expiry(info)
+        if url_expiry:
+            expires = min(expires, url_expiry - METADATA_EXPIRY_MARGIN)
+        if expires <= now:
+            return
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO extractions (video, egress, info, expires) VALUES (?, ?, ?, ?)',
+                       (canonical_video_id(url), egress_key(proxy), json.dumps(info), expires))
+            db.execute('DELETE FROM extractions WHERE expires <= ?', (now,))
+
+
+class ResultCache(SQLiteStore):
+    """LRU cache of finished files: <root>/<key>/<filename>, indexed in <root>/index.db"""
+
+    def __init__(self, root, max_bytes=CACHE_MAX_BYTES):
+        super().__init__(os.path.join(root, 'index.db'))
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        with self._connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS artifacts (
+                key TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_access REAL NOT NULL
+            )''')
+            db.execute('CREATE INDEX IF NOT EXISTS artifacts_lru ON artifacts (last_access)')
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _dir(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        """Path of the cached file for key, or None"""
+        if not self.enabled:
+            return None
+        with self._connect() as db:
+            row = db.execute('SELECT filename FROM artifacts WHERE key = ?', (key,)).fetchone()
+            if not row:
+                return None
+            path = os.path.join(self._dir(key), row[0])
+            if not os.path.exists(path):
+                db.execute('DELETE FROM artifacts WHERE key = ?', (key,))
+                return None
+            db.execute('UPDATE artifacts SET last_access = ? WHERE key = ?', (time.time(), key))
+        return path
+
+    def put(self, key, filepath):
+        """Move a finished file into the cache and return its new path
+
+        Files larger than the whole budget are left where they are.
+        """
+        size = os.path.getsize(filepath)
+        if not self.enabled or size > self.max_bytes:
+            return filepath
+
+        filename = os.path.basename(filepath)
+        final_dir = self._dir(key)
+        tmp_dir = f'{final_dir}.{uuid.uuid4().hex}.tmp'
+        os.makedirs(tmp_dir)
+        shutil.move(filepath, os.path.join(tmp_dir, filename))
+
+        try:
+            os.rename(tmp_dir, final_dir)
+        except OSError:
+            existing = self.get(key)
+            if existing:
+                # Another worker cached the same key first; keep theirs
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return existing
+            # Leftover directory without an index row
+            shutil.rmtree(final_dir, ignore_errors=True)
+            os.rename(tmp_dir, final_dir)
+
+        now = time.time()
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO artifacts (key, filename, size, created, last_access) VALUES (?, ?, ?, ?, ?)',
+                       (key, filename, size, now, now))
+        self.evict()
+        return os.path.join(final_dir, filename)
+
+    def evict(self):
+        """Delete least recently used artifacts until the cache fits its budget"""
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                total = db.execute('SELECT COALESCE(SUM(size), 0) FROM artifacts').fetchone()[0]
+                victims = []
+                if total > self.max_bytes:
+                    for key, size in db.execute('SELECT key, size FROM artifacts ORDER BY last_access').fetchall():
+                        if total <= self.max_bytes:
+                            break
+                        victims.append(key)
+                        total -= size
+                    db.executemany('DELETE FROM artifacts WHERE key = ?', [(k,) for k in victims])
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+
+        # Open file handles keep serving a deleted file, so in-flight sends are safe
+        for key in victims:
+            shutil.rmtree(self._dir(key), ignore_errors=True)
+        if victims:
+            log.info("Evicted %d cached file(s), %d bytes in use", len(victims), total)
+
+    def stats(self):
+        """Entry count and bytes used"""
+        with self._connect() as db:
+            count, size = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM artifacts').fetchone()
+        return {'entries': count, 'bytes': size, 'max_bytes': self.max_bytes}
@@ -52,7 +52,7 @@ User=$USER
 WorkingDirectory=/opt/VideoDownloader
 Environment="PATH=/opt/VideoDownloader/venv/bin"
 Environment="PORT=5000"
-ExecStart=/opt/VideoDownloader/venv/bin/gunicorn --workers 3 --bind 0.0.0.0:5000 --timeout 300 app:app
+ExecStart=/opt/VideoDownloader/venv/bin/gunicorn -c gunicorn.conf.py --workers 3 --bind 0.0.0.0:5000 --timeout 300 app:app
 Restart=always
 RestartSec=10
 
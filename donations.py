@@ -0,0 +1,151 @@
+"""
+Donation goal progress for /api/donations
+One refresher per host scrapes Ko-fi on an interval and writes the result to a
+shared state file; every worker serves the percentage from memory, re-reading
+the state file and the donations.json fallback only when they change.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from locks import file_lock, write_atomic
+from sessions import http_session
+
+log = logging.getLogger(__name__)
+
+KOFI_URL = 'https://ko-fi.com/universalvideodownloader/goal?g=0'
+REFRESH_INTERVAL = int(os.environ.get('DONATIONS_REFRESH_INTERVAL', 300))  # seconds, 0 disables
+STAT_INTERVAL = 2  # seconds between mtime checks of the state files
+
+
+def fetch_kofi_percentage():
+    """Scrape the goal percentage from Ko-fi, or None if it cannot be found"""
+    from bs4 import BeautifulSoup
+
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+    }
+
+    response = http_session().get(KOFI_URL, headers=headers, timeout=5)
+    if response.status_code != 200:
+        return None
+
+    soup = BeautifulSoup(response.text, 'html.parser')
+
+    # Try to find goal progress in the page
+    # Ko-fi typically has progress data in their goal widget
+    # Look for percentage or progress indicators
+
+    # Try to find progress percentage
+    progress_elements = soup.find_all(['div', 'span'], class_=lambda x: x and 'progress' in x.lower())
+
+    for element in progress_elements:
+        text = element.get_text().strip()
+        if '%' in text:
+            # Extract percentage
+            percentage = int(''.join(filter(str.isdigit, text)))
+            if 0 <= percentage <= 100:
+                return percentage
+
+    # Try to find goal amounts
+    amounts = soup.find_all(string=lambda text: text and '$' in str(text))
+    for amount_text in amounts:
+        # Look for patterns like "$150 / $500" or "$150 of $500"
+        if '/' in amount_text or ' of ' in amount_text:
+            try:
+                parts = amount_text.replace('$', '').replace(',', '')
+                if '/' in parts:
+                    current, goal = parts.split('/')
+                else:
+                    current, goal = parts.split(' of ')
+
+                current = float(current.strip())
+                goal = float(goal.strip())
+
+                if goal > 0:
+                    return min(int((current / goal) * 100), 100)
+            except:
+                continue
+
+    return None
+
+
+class DonationProgress:
+    """Goal percentage served from memory, refreshed in the background"""
+
+    def __init__(self, state_path, fallback_path):
+        self.state_path = state_path
+        self.fallback_path = fallback_path
+        self.lock_path = f'{state_path}.lock'
+        self.files = {}  # path -> (mtime, parsed json)
+        self.checked = 0
+        self.value = 0
+        self.thread = None
+
+    def _read_json(self, path):
+        # Parse a file again only if its mtime changed
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            self.files.pop(path, None)
+            return None
+        cached = self.files.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return cached[1] if cached else None
+        self.files[path] = (mtime, data)
+        return data
+
+    def percentage(self):
+        """Current percentage: Ko-fi if the last refresh found one, else donations.json"""
+        now = time.time()
+        if now - self.checked < STAT_INTERVAL:
+            return self.value
+        self.checked = now
+
+        state = self._read_json(self.state_path)
+        if state and state.get('percentage') is not None:
+            self.value = state['percentage']
+            return self.value
+
+        # Fallback to local file if Ko-fi fetch fails
+        data = self._read_json(self.fallback_path) or {}
+        current = data.get('current', 0)
+        goal = data.get('goal', 500)
+        self.value = min(int((current / goal) * 100), 100) if goal > 0 else 0
+        return self.value
+
+    def refresh(self):
+        """Fetch Ko-fi once and publish the result to every worker"""
+        try:
+            percentage = fetch_kofi_percentage()
+        except Exception as e:
+            log.warning("Error fetching donations: %s", e)
+            percentage = None
+
+        write_atomic(self.state_path, json.dumps({'percentage': percentage, 'updated': time.time()}))
+
+    def _refresh_forever(self, interval):
+        with file_lock(self.lock_path):
+            while True:
+                self.refresh()
+                time.sleep(interval)
+
+    def start_refresher(self, interval=REFRESH_INTERVAL):
+        """Start the background refresher thread for this process (idempotent)
+
+        Only the process holding the host-wide lock refreshes; the others take
+        over if it exits.
+        """
+        if interval <= 0 or (self.thread and self.thread.is_alive()):
+            return
+        self.thread = threading.Thread(target=self._refresh_forever, args=(interval,),
+                                       name='donations-refresher', daemon=True)
+        self.thread.start()
@@ -0,0 +1,32 @@
+"""
+Gunicorn settings (read automatically from the working directory)
+Command line flags, e.g. --workers in deploy_digitalocean.sh, still take precedence.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 300))
+
+# Threaded workers: every request gets a thread, so downloads, streams and event
+# streams waiting on the network no longer hold up /api/health and the pages.
+# Idle keep-alive connections wait in the worker's event loop without a thread.
+# The app's locks, SQLite stores and yt-dlp all block, which rules out an event
+# loop (gevent/ASGI); CPU-heavy extraction is bounded separately (EXTRACT_WORKERS).
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 100))  # concurrent requests per worker
+worker_connections = int(os.environ.get('GUNICORN_MAX_CONNECTIONS', 1000))  # open connections per worker
+keepalive = 5  # seconds
+
+# Import the app once in the master and fork workers from it. With the extractor
+# stack preloaded too, workers start instantly and share those pages copy-on-write.
+preload_app = os.environ.get('PRELOAD_APP', 'True') == 'True'
+if preload_app:
+    os.environ.setdefault('PRELOAD_EXTRACTORS', 'True')
+
+
+def post_worker_init(worker):
+    """Threads do not survive fork, so each worker starts its own"""
+    from app import start_background_tasks
+    start_background_tasks()
@@ -0,0 +1,166 @@
+"""
+Hedged downloads across backends (pytubefix clients, yt-dlp)
+The backend most likely to finish first starts alone. If it fails, or has not
+received its first byte within HEDGE_DELAY seconds, the next one starts as well.
+The first success wins and the others are told to stop. Backend order comes
+from success rates and latencies shared by all workers.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+
+import metrics
+from cache import SQLiteStore
+
+log = logging.getLogger(__name__)
+
+HEDGE_DELAY = float(os.environ.get('HEDGE_DELAY', 8))  # seconds without a first byte
+STATS_ALPHA = 0.2  # weight of the newest outcome in the moving averages
+
+# Assumed for backends without history, so they still get tried
+PRIOR_SUCCESS = 0.8
+PRIOR_LATENCY = 10.0
+
+
+class Cancelled(Exception):
+    """Raised inside a backend once another backend has won"""
+
+
+class Attempt:
+    """Handle passed to a backend so it can report progress and notice cancellation"""
+
+    def __init__(self, name):
+        self.name = name
+        self.cancelled = threading.Event()
+        self.receiving = threading.Event()
+
+    def progress(self, *args, **kwargs):
+        """Progress callback for yt-dlp hooks and pytubefix on_progress"""
+        if self.cancelled.is_set():
+            raise Cancelled(f'{self.name} cancelled')
+        self.receiving.set()
+
+
+class BackendStats(SQLiteStore):
+    """Moving averages of success and time-to-result per backend"""
+
+    def __init__(self, db_path):
+        super().__init__(db_path)
+        with self._connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS backends (
+                name TEXT PRIMARY KEY,
+                success REAL NOT NULL,
+                latency REAL NOT NULL,
+                wins INTEGER NOT NULL DEFAULT 0,
+                failures INTEGER NOT NULL DEFAULT 0,
+                updated REAL NOT NULL
+            )''')
+
+    def record(self, name, ok, latency):
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT success, latency FROM backends WHERE name = ?', (name,)).fetchone()
+            success, avg_latency = row or (PRIOR_SUCCESS, PRIOR_LATENCY)
+            success += STATS_ALPHA * ((1.0 if ok else 0.0) - success)
+            if ok:
+                avg_latency += STATS_ALPHA * (latency - avg_latency)
+            db.execute('''INSERT INTO backends (name, success, latency, wins, failures, updated)
+                          VALUES (?, ?, ?, ?, ?, ?)
+                          ON CONFLICT(name) DO UPDATE SET success = excluded.success,
+                              latency = excluded.latency, wins = wins + excluded.wins,
+                              failures = failures + excluded.failures, updated = excluded.updated''',
+                       (name, success, avg_latency, int(ok), int(not ok), time.time()))
+            db.execute('COMMIT')
+
+    def order(self, names):
+        """names sorted by expected time to a successful result (ties keep their order)"""
+        with self._connect() as db:
+            rows = dict((name, (success, latency)) for name, success, latency in
+                        db.execute('SELECT name, success, latency FROM backends').fetchall())
+
+        def expected(name):
+            success, latency = rows.get(name, (PRIOR_SUCCESS, PRIOR_LATENCY))
+            return latency / max(success, 0.05)
+
+        return sorted(names, key=expected)
+
+    def stats(self):
+        with self._connect() as db:
+            rows = db.execute('SELECT name, success, latency, wins, failures FROM backends').fetchall()
+        return [{
+            'backend': name,
+            'success_rate': round(success, 3),
+            'latency': round(latency, 1),
+            'wins': wins,
+            'failures': failures,
+        } for name, success, latency, wins, failures in rows]
+
+
+def run_hedged(backends, stats, delay=HEDGE_DELAY):
+    """Run backends, hedging as described above; returns (name, result) of the winner
+
+    backends is a list of (name, fn) in preference order; fn(attempt) returns a
+    result, or None/raises on failure. If every backend fails, the last error is
+    raised, or (None, None) returned if none raised.
+    """
+    results = queue.Queue()
+    attempts = []
+    remaining = list(backends)
+
+    def run(attempt, fn):
+        started = time.time()
+        try:
+            result, error = fn(attempt), None
+        except Exception as e:
+            result, error = None, e
+        duration = time.time() - started
+        if attempt.cancelled.is_set():
+            outcome = 'cancelled'
+        else:
+            outcome = 'ok' if result is not None else 'failed'
+            stats.record(attempt.name, result is not None, duration)
+        metrics.BACKEND_SECONDS.observe(duration, backend=attempt.name, outcome=outcome)
+        results.put((attempt, result, error))
+
+    def launch(reason=None):
+        name, fn = remaining.pop(0)
+        attempt = Attempt(name)
+        attempts.append(attempt)
+        if reason:
+            metrics.HEDGES.inc(backend=name, reason=reason)
+        log.info("Hedge: starting %s%s", name, f' ({reason})' if reason else '')
+        threading.Thread(target=run, args=(attempt, fn), name=f'hedge-{name}', daemon=True).start()
+
+    launch()
+    running = 1
+    last_error = None
+    try:
+        while running:
+            try:
+                attempt, result, error = results.get(timeout=delay)
+            except queue.Empty:
+                # Hedge only if nothing is downloading yet
+                if remaining and not any(a.receiving.is_set() for a in attempts):
+                    launch('delay')
+                    running += 1
+                continue
+
+            running -= 1
+            if result is not None:
+                log.info("Hedge: %s won", attempt.name)
+                return attempt.name, result
+            if not isinstance(error, Cancelled):
+                log.info("Hedge: %s failed%s", attempt.name, f': {error}' if error else '')
+                last_error = error or last_error
+            if remaining:
+                launch('error')
+                running += 1
+        if last_error:
+            raise last_error
+        return None, None
+    finally:
+        for attempt in attempts:
+            attempt.cancelled.set()
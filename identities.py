@@ -0,0 +1,230 @@
+"""
+Egress identity pool: cookie files paired with proxies
+Identities are scheduled by health score (success rate, latency, recent bot
+checks). Repeated bot checks quarantine an identity; once the quarantine ends
+it is probed with single requests until it succeeds again. Health is kept in
+SQLite so every gunicorn worker schedules from the same picture.
+"""
+
+import glob
+import logging
+import os
+import platform
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+from cache import SQLiteStore
+
+log = logging.getLogger(__name__)
+
+# Extra proxies, comma separated (HTTP_PROXY/HTTPS_PROXY are also used)
+PROXIES = [p.strip() for p in os.environ.get('PROXIES', '').split(',') if p.strip()]
+
+RELOAD_INTERVAL = 5  # seconds between checks for new/changed cookie files
+QUARANTINE_AFTER = int(os.environ.get('IDENTITY_QUARANTINE_AFTER', 3))  # consecutive bot checks
+QUARANTINE_SECONDS = int(os.environ.get('IDENTITY_QUARANTINE_SECONDS', 900))
+PROBE_INTERVAL = 60  # seconds between recovery probes of a quarantined identity
+EWMA_ALPHA = 0.2
+MIN_WEIGHT = 0.02
+
+
+def redact_proxy(proxy):
+    """host:port of a proxy URL, without credentials"""
+    parsed = urlparse(proxy if '://' in proxy else f'http://{proxy}')
+    return f'{parsed.hostname}:{parsed.port}' if parsed.port else (parsed.hostname or 'proxy')
+
+
+class Identity:
+    """One cookie jar + proxy combination requests can be sent from"""
+
+    def __init__(self, cookiefile=None, proxy=None, browser_cookies=False):
+        self.cookiefile = cookiefile
+        self.proxy = proxy
+        self.browser_cookies = browser_cookies
+
+    @property
+    def key(self):
+        if self.cookiefile:
+            cookies = os.path.basename(self.cookiefile)
+        elif self.browser_cookies:
+            cookies = 'browser'
+        else:
+            cookies = 'no-cookies'
+        return f"{cookies}|{redact_proxy(self.proxy) if self.proxy else 'direct'}"
+
+    def apply(self, opts):
+        """Set cookie and proxy options on a yt-dlp options dict"""
+        if self.proxy:
+            opts['proxy'] = self.proxy
+        if self.cookiefile:
+            opts['cookiefile'] = self.cookiefile
+        elif self.browser_cookies:
+            opts['cookiesfrombrowser'] = ('chrome',)
+        return opts
+
+
+class IdentityPool(SQLiteStore):
+    """Health-weighted scheduler over all cookie/proxy identities"""
+
+    def __init__(self, db_path, cookie_dir, proxies=PROXIES):
+        super().__init__(db_path)
+        self.cookie_dir = cookie_dir
+        self.extra_proxies = proxies
+        self.lock = threading.Lock()
+        self.identities = []
+        self.signature = None
+        self.checked = 0
+        with self._connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS identity_health (
+                key TEXT PRIMARY KEY,
+                successes INTEGER NOT NULL DEFAULT 0,
+                failures INTEGER NOT NULL DEFAULT 0,
+                success_rate REAL NOT NULL DEFAULT 1,
+                latency REAL NOT NULL DEFAULT 0,
+                consecutive_bot_checks INTEGER NOT NULL DEFAULT 0,
+                last_bot_check REAL NOT NULL DEFAULT 0,
+                quarantined_until REAL NOT NULL DEFAULT 0,
+                last_probe REAL NOT NULL DEFAULT 0
+            )''')
+
+    def _proxies(self):
+        proxies = list(self.extra_proxies)
+        env_proxy = os.environ.get('HTTP_PROXY') or os.environ.get('HTTPS_PROXY')
+        if env_proxy and env_proxy not in proxies:
+            proxies.insert(0, env_proxy)
+        return proxies
+
+    def reload(self, force=False):
+        """Rebuild identities if cookie files or proxies changed (checked every RELOAD_INTERVAL)"""
+        now = time.time()
+        if not force and now - self.checked < RELOAD_INTERVAL:
+            return
+        with self.lock:
+            # Checked again under the lock: another thread may have just reloaded
+            if not force and now - self.checked < RELOAD_INTERVAL:
+                return
+            cookie_files = sorted(glob.glob(os.path.join(self.cookie_dir, 'cookies*.txt')))
+            proxies = self._proxies()
+            signature = (tuple((f, os.path.getmtime(f)) for f in cookie_files if os.path.exists(f)), tuple(proxies))
+            if signature == self.signature:
+                self.checked = now
+                return
+            self.signature = signature
+
+            # Each cookie account keeps a fixed proxy, so one account is not seen from many IPs
+            if cookie_files:
+                identities = [Identity(cookiefile=f, proxy=proxies[i % len(proxies)] if proxies else None)
+                              for i, f in enumerate(cookie_files)]
+            else:
+                log.warning("No cookies*.txt files found! Production downloads may fail. "
+                            "Get cookies: https://chrome.google.com/webstore/detail/get-cookiestxt-locally/cclelndahbckbenkjhflpdbgdldlbecc "
+                            "and save one file per account as cookies1.txt, cookies2.txt, cookies3.txt")
+                # Only use browser cookies locally where Chrome is installed
+                browser = platform.system() == 'Windows' or os.path.exists(os.path.expanduser('~/.config/google-chrome'))
+                identities = [Identity(proxy=p, browser_cookies=browser) for p in proxies or [None]]
+
+            self.identities = identities
+            # Only marked as checked once loaded, so concurrent threads never see an empty pool
+            self.checked = now
+            log.info("Loaded %d egress identit%s: %s", len(identities), 'y' if len(identities) == 1 else 'ies',
+                     ', '.join(i.key for i in identities))
+
+    def _health(self):
+        with self._connect() as db:
+            rows = db.execute('''SELECT key, successes, failures, success_rate, latency, consecutive_bot_checks,
+                                        last_bot_check, quarantined_until, last_probe FROM identity_health''').fetchall()
+        columns = ('successes', 'failures', 'success_rate', 'latency', 'consecutive_bot_checks',
+                   'last_bot_check', 'quarantined_until', 'last_probe')
+        return {row[0]: dict(zip(columns, row[1:])) for row in rows}
+
+    @staticmethod
+    def score(health, now=None):
+        """0..1 weight from success rate, latency and how recently a bot check was hit"""
+        if not health:
+            return 1.0
+        now = now or time.time()
+        latency_factor = 1 / (1 + health['latency'] / 30)
+        bot_factor = min(1.0, (now - health['last_bot_check']) / QUARANTINE_SECONDS)
+        return max(MIN_WEIGHT, health['success_rate'] * latency_factor * (0.5 + 0.5 * bot_factor))
+
+    def choose(self):
+        """Pick an identity, weighted by health; quarantined ones only as recovery probes"""
+        self.reload()
+        identities = self.identities
+        now = time.time()
+        health = self._health()
+
+        available, weights = [], []
+        for identity in identities:
+            h = health.get(identity.key)
+            if h and h['quarantined_until'] > now:
+                continue
+            if h and h['consecutive_bot_checks'] >= QUARANTINE_AFTER:
+                # Quarantine is over: allow one probe per PROBE_INTERVAL until it succeeds
+                if now - h['last_probe'] < PROBE_INTERVAL or not self._claim_probe(identity.key, now):
+                    continue
+                log.info("Probing quarantined identity %s", identity.key)
+                return identity
+            available.append(identity)
+            weights.append(self.score(h, now))
+
+        if available:
+            return random.choices(available, weights=weights)[0]
+
+        # Everything is quarantined: use the one that comes out soonest
+        return min(identities, key=lambda i: health.get(i.key, {}).get('quarantined_until', 0))
+
+    def _claim_probe(self, key, now):
+        # Only one worker may probe an identity per interval
+        with self._connect() as db:
+            claimed = db.execute('UPDATE identity_health SET last_probe = ? WHERE key = ? AND last_probe < ?',
+                                 (now, key, now - PROBE_INTERVAL)).rowcount
+        return claimed == 1
+
+    def report(self, key, ok, latency=None, bot_check=False):
+        """Record the outcome of one upstream request made from identity key"""
+        now = time.time()
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('INSERT OR IGNORE INTO identity_health (key) VALUES (?)', (key,))
+            row = db.execute('SELECT success_rate, latency, consecutive_bot_checks FROM identity_health WHERE key = ?',
+                             (key,)).fetchone()
+            success_rate = (1 - EWMA_ALPHA) * row[0] + EWMA_ALPHA * (1 if ok else 0)
+            latency_avg = row[1] if latency is None else (latency if row[1] == 0 else (1 - EWMA_ALPHA) * row[1] + EWMA_ALPHA * latency)
+            bot_checks = 0 if ok else row[2] + (1 if bot_check else 0)
+            quarantined_until = 0
+            if bot_checks >= QUARANTINE_AFTER:
+                quarantined_until = now + QUARANTINE_SECONDS
+            db.execute('''UPDATE identity_health SET
+                              successes = successes + ?, failures = failures + ?, success_rate = ?, latency = ?,
+                              consecutive_bot_checks = ?, last_bot_check = CASE WHEN ? THEN ? ELSE last_bot_check END,
+                              quarantined_until = CASE WHEN ? > 0 THEN ? ELSE quarantined_until END
+                          WHERE key = ?''',
+                       (1 if ok else 0, 0 if ok else 1, success_rate, latency_avg, bot_checks,
+                        bot_check, now, quarantined_until, quarantined_until, key))
+            if ok:
+                db.execute('UPDATE identity_health SET quarantined_until = 0 WHERE key = ?', (key,))
+            db.execute('COMMIT')
+        if quarantined_until:
+            log.warning("Quarantined identity %s for %ds after %d bot checks", key, QUARANTINE_SECONDS, bot_checks)
+
+    def stats(self):
+        """Health and score of every configured identity"""
+        self.reload()
+        now = time.time()
+        health = self._health()
+        report = []
+        for identity in self.identities:
+            h = health.get(identity.key) or {}
+            report.append({
+                'identity': identity.key,
+                'score': round(self.score(h, now), 3),
+                'success_rate': round(h.get('success_rate', 1), 3),
+                'latency': round(h.get('latency', 0), 2),
+                'successes': h.get('successes', 0),
+                'failures': h.get('failures', 0),
+                'quarantined_for': round(max(0, h.get('quarantined_until', 0) - now), 1),
+            })
+        return report
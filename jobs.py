@@ -0,0 +1,269 @@
+"""
+Background download jobs
+Runs downloads on a bounded worker pool so request threads return immediately
+"""
+
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+
+import metrics
+from locks import file_lock, write_atomic
+from progress import ProgressReporter, read_progress
+
+log = logging.getLogger(__name__)
+
+# Pool sizing (override via environment)
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 20))
+JOB_RETRY_AFTER = int(os.environ.get('JOB_RETRY_AFTER', 15))  # seconds, sent with 503
+JOB_TTL = int(os.environ.get('JOB_TTL', 3600))  # seconds a finished job is kept
+
+
+class QueueFull(Exception):
+    """Raised when the job queue has no room for another download"""
+
+
+class JobQueue:
+    """Bounded worker pool with job state persisted as one JSON file per job
+
+    State lives on disk so any gunicorn worker can answer status and result
+    requests, not only the one that accepted the job. Every job downloads
+    into its own directory under work_root, which is removed with the job.
+    Jobs submitted with the same key while one is still pending share it.
+
+    The queue itself is in the memory of the process that accepted a job. Each
+    process holds a lock file for as long as it lives, so a pending job whose
+    owner has died (restart, crash) is seen as failed instead of waiting forever.
+    """
+
+    def __init__(self, handler, state_dir, work_root, workers=JOB_WORKERS, max_queued=JOB_QUEUE_SIZE):
+        self.handler = handler
+        self.state_dir = state_dir
+        self.work_root = work_root
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=max(1, max_queued))
+        self.lock = threading.Lock()
+        self.threads = []
+        self.inflight_dir = os.path.join(state_dir, 'inflight')
+        self.owners_dir = os.path.join(state_dir, 'owners')
+        self.owner = None
+        self.owner_pid = None
+        self.owner_lock = None
+        os.makedirs(self.inflight_dir, exist_ok=True)
+        os.makedirs(self.owners_dir, exist_ok=True)
+        os.makedirs(work_root, exist_ok=True)
+
+    def _path(self, job_id):
+        return os.path.join(self.state_dir, f'{job_id}.json')
+
+    def _inflight_path(self, key):
+        return os.path.join(self.inflight_dir, key)
+
+    def progress_path(self, job_id):
+        return os.path.join(self.state_dir, f'{job_id}.progress.json')
+
+    def progress(self, job_id):
+        """Latest progress published by the job's download, or None"""
+        return read_progress(self.progress_path(job_id))
+
+    def signature(self, job_id):
+        """mtimes of the job record and its progress file, to notice changes without reading them"""
+        signature = []
+        for path in (self._path(job_id), self.progress_path(job_id)):
+            try:
+                signature.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def work_dir(self, job_id):
+        """Scratch directory owned by one job"""
+        return os.path.join(self.work_root, job_id)
+
+    def _write(self, job):
+        write_atomic(self._path(job['id']), json.dumps(job))
+
+    def _owner_path(self, owner):
+        return os.path.join(self.owners_dir, f'{owner}.lock')
+
+    def _claim_owner(self):
+        # Held until this process exits; the lock is released by the kernel then
+        if self.owner_pid == os.getpid():
+            return
+        owner = uuid.uuid4().hex
+        lock = file_lock(self._owner_path(owner))
+        lock.__enter__()
+        self.owner_lock = lock
+        self.owner = owner
+        self.owner_pid = os.getpid()
+
+    def _owner_alive(self, owner):
+        """True while the process that took a job (by its owner token) is running"""
+        if owner is None or owner == self.owner:
+            # Records from before owners were tracked are trusted
+            return True
+        path = self._owner_path(owner)
+        if not os.path.exists(path):
+            return False
+        with file_lock(path, blocking=False) as acquired:
+            if acquired:
+                os.remove(path)
+        return not acquired
+
+    def _start_workers(self):
+        # Threads are started lazily so they are created after gunicorn forks
+        with self.lock:
+            self._claim_owner()
+            self.threads = [t for t in self.threads if t.is_alive()]
+            for i in range(self.workers - len(self.threads)):
+                t = threading.Thread(target=self._work, name=f'download-worker-{i}', daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def submit(self, params, key=None):
+        """Queue a download and return its job record, or raise QueueFull
+
+        If a job with the same key is still queued or running (in any worker
+        process), that job is returned instead of starting a second download.
+        """
+        self._start_workers()
+        self.sweep()
+
+        if not key:
+            return self._enqueue(params)
+
+        inflight = self._inflight_path(key)
+        with file_lock(f'{inflight}.lock'):
+            try:
+                with open(inflight, 'r') as f:
+                    existing = self.get(f.read().strip())
+            except OSError:
+                existing = None
+
+            if existing and existing['status'] in ('queued', 'running'):
+                log.info("Joining in-flight job %s", existing['id'])
+                return self.update(existing['id'], shared=True) or existing
+
+            job = self._enqueue(params)
+            with open(inflight, 'w') as f:
+                f.write(job['id'])
+            return job
+
+    def _enqueue(self, params):
+        now = time.time()
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': 'queued',
+            'params': params,
+            'created': now,
+            'updated': now,
+            'filepath': None,
+            'filename': None,
+            'error': None,
+            'shared': False,
+            'owner': self.owner,
+        }
+        self._write(job)
+        try:
+            self.queue.put_nowait(job['id'])
+        except queue.Full:
+            os.remove(self._path(job['id']))
+            raise QueueFull(f'Download queue is full ({self.queue.maxsize} jobs waiting)')
+        return job
+
+    def get(self, job_id):
+        """Return the stored job record, or None if unknown
+
+        A queued or running job whose owning process is gone is marked failed.
+        """
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(self._path(job_id), 'r') as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if job['status'] in ('queued', 'running') and not self._owner_alive(job.get('owner')):
+            log.warning("Job %s was lost with its worker process", job_id)
+            job.update(status='error', error='Download was interrupted, please try again',
+                       finished=time.time(), updated=time.time())
+            self._write(job)
+        return job
+
+    def update(self, job_id, **fields):
+        """Merge fields into a job record and persist it"""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.update(fields)
+        job['updated'] = time.time()
+        self._write(job)
+        return job
+
+    def depth(self):
+        """Number of jobs waiting for a worker"""
+        return self.queue.qsize()
+
+    def cleanup(self, job_id):
+        """Remove the files a job downloaded"""
+        shutil.rmtree(self.work_dir(job_id), ignore_errors=True)
+
+    def sweep(self):
+        """Delete job records and scratch directories older than JOB_TTL"""
+        cutoff = time.time() - JOB_TTL
+        for directory in (self.state_dir, self.inflight_dir):
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                try:
+                    if os.path.isfile(path) and os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except OSError:
+                    pass
+        sweep_stale(self.work_root, cutoff)
+        # Lock files of processes that have exited
+        for name in os.listdir(self.owners_dir):
+            if name.endswith('.lock'):
+                self._owner_alive(name[:-len('.lock')])
+
+    def _work(self):
+        while True:
+            job_id = self.queue.get()
+            try:
+                job = self.update(job_id, status='running', started=time.time())
+                if job is None:
+                    continue
+                try:
+                    work_dir = self.work_dir(job_id)
+                    os.makedirs(work_dir, exist_ok=True)
+                    reporter = ProgressReporter(self.progress_path(job_id))
+                    filepath = os.path.abspath(self.handler(work_dir=work_dir, progress=reporter, **job['params']))
+                    self.update(job_id, status='done', filepath=filepath,
+                                filename=os.path.basename(filepath), finished=time.time())
+                    metrics.JOBS.inc(status='done')
+                except Exception as e:
+                    log.exception("Job %s failed: %s", job_id, e)
+                    self.update(job_id, status='error', error=str(e), finished=time.time())
+                    metrics.JOBS.inc(status='error')
+                    self.cleanup(job_id)
+            finally:
+                self.queue.task_done()
+
+
+def sweep_stale(root, cutoff):
+    """Remove files and directories in root last modified before cutoff (orphans of killed workers)"""
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+        except OSError:
+            pass
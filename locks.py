@@ -0,0 +1,88 @@
+"""
+File locks and atomic file writes shared by threads and gunicorn worker processes
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to locks within this process only
+    fcntl = None
+
+_local_locks = {}
+_local_locks_guard = threading.Lock()
+
+
+def _local_lock(path):
+    with _local_locks_guard:
+        return _local_locks.setdefault(path, threading.Lock())
+
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """Hold an exclusive lock on path; yields False if non-blocking and already held
+
+    flock locks belong to the open file, so two threads of one process exclude
+    each other just like two processes do.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    if fcntl is None:
+        lock = _local_lock(path)
+        acquired = lock.acquire(blocking)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                lock.release()
+        return
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        # Touch the lock so sweepers can tell it is in use
+        os.utime(fd)
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def write_atomic(path, data, mode=0o644, replace=True):
+    """Write data (str or bytes) to path via a temp file, so readers never see a partial file
+
+    The temp file is named per process and thread, so concurrent writers of one
+    path never rename each other's files. With replace=False an existing file
+    is kept (the first writer wins) and False is returned.
+    """
+    directory, name = os.path.split(path)
+    tmp = os.path.join(directory, f'.{name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        if isinstance(data, bytes):
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+        else:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(data)
+        if replace:
+            os.replace(tmp, path)
+            return True
+        try:
+            os.link(tmp, path)
+            return True
+        except FileExistsError:
+            return False
+    finally:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,43 @@
+"""
+Logging setup: leveled log lines instead of bare prints
+LOG_LEVEL picks the threshold (default INFO) and LOG_FORMAT=json emits one JSON
+object per line for log collectors.
+"""
+
+import json
+import logging
+import os
+import sys
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def configure_logging(level=LOG_LEVEL, fmt=LOG_FORMAT):
+    """Send all log records to stderr (where gunicorn and hosting platforms collect them)"""
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
@@ -0,0 +1,244 @@
+"""
+Low-overhead metrics, aggregated across gunicorn workers in Prometheus text format
+Each process keeps counters and histograms in memory and writes a snapshot to
+<metrics dir>/<pid>.json every few seconds. /api/metrics merges the snapshots of all
+live workers, so any worker can answer a scrape.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from locks import write_atomic
+
+log = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = int(os.environ.get('METRICS_FLUSH_INTERVAL', 5))  # seconds
+
+# Latency buckets in seconds, from a metadata cache hit to a long download
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_lock = threading.Lock()
+_registry = {}
+_collectors = []
+_state = {'dir': None, 'flusher': None}
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, shared=False):
+        """shared metrics describe the whole host (e.g. cache size) and are not summed across workers"""
+        self.name = name
+        self.help = help_text
+        self.shared = shared
+        self.values = {}
+        _registry[name] = self
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with _lock:
+            self.values[_label_key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with _lock:
+            # [count per bucket..., +Inf count, sum]
+            data = self.values.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            else:
+                data[len(self.buckets)] += 1
+            data[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+
+# Download pipeline
+STAGE_SECONDS = Histogram('videodl_stage_seconds',
+                          'Time spent per stage (extract, rate_limit, download, postprocess_wait, postprocess, send, stream)')
+BACKEND_SECONDS = Histogram('videodl_backend_seconds', 'Duration of download backend attempts by outcome')
+HEDGES = Counter('videodl_backend_fallbacks_total', 'Backends started in addition to the first, by reason')
+UPSTREAM_BYTES = Counter('videodl_upstream_bytes_total', 'Bytes downloaded from upstream sites')
+CACHE_LOOKUPS = Counter('videodl_cache_lookups_total', 'Result and metadata cache lookups by result')
+JOBS = Counter('videodl_jobs_total', 'Finished download jobs by status')
+PREFETCHES = Counter('videodl_prefetches_total', 'Prefetch requests by outcome')
+
+# HTTP
+REQUEST_SECONDS = Histogram('videodl_request_seconds', 'Time to build a response, by endpoint')
+RESPONSES = Counter('videodl_responses_total', 'Responses by endpoint and status code')
+RESPONSE_BYTES = Counter('videodl_response_bytes_total', 'Bytes sent with a known length, by endpoint')
+
+# Queues (set by collectors just before each snapshot)
+JOB_QUEUE_DEPTH = Gauge('videodl_job_queue_depth', 'Download jobs waiting for a worker')
+POSTPROCESS_WAITING = Gauge('videodl_postprocess_waiting', 'Downloads waiting for an ffmpeg slot')
+POSTPROCESS_RUNNING = Gauge('videodl_postprocess_running', 'ffmpeg post-processing runs in progress')
+CACHE_BYTES = Gauge('videodl_result_cache_bytes', 'Bytes stored in the result cache', shared=True)
+
+
+def add_collector(fn):
+    """Call fn() before every snapshot, e.g. to set gauges from current state"""
+    _collectors.append(fn)
+
+
+def _snapshot():
+    for fn in _collectors:
+        try:
+            fn()
+        except Exception:
+            log.exception('Metrics collector failed')
+    with _lock:
+        return {name: [[list(k), v] for k, v in metric.values.items()]
+                for name, metric in _registry.items() if not metric.shared}
+
+
+def configure(directory):
+    """Set where snapshots are written"""
+    os.makedirs(directory, exist_ok=True)
+    _state['dir'] = directory
+
+
+def flush():
+    """Write this process's snapshot"""
+    directory = _state['dir']
+    if not directory:
+        return
+    # Called by the flusher thread and by every /api/metrics request
+    write_atomic(os.path.join(directory, f'{os.getpid()}.json'), json.dumps(_snapshot()))
+
+
+def _flush_forever():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception:
+            log.exception('Writing metrics snapshot failed')
+
+
+def start_flusher():
+    """Start this process's snapshot thread (idempotent; call after forking)"""
+    thread = _state['flusher']
+    if thread and thread.is_alive():
+        return
+    _state['flusher'] = threading.Thread(target=_flush_forever, name='metrics-flusher', daemon=True)
+    _state['flusher'].start()
+
+
+def _alive(pid):
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(total, values):
+    for key, value in values:
+        key = tuple(tuple(pair) for pair in key)
+        if isinstance(value, list):
+            current = total.setdefault(key, [0] * len(value))
+            total[key] = [a + b for a, b in zip(current, value)]
+        else:
+            total[key] = total.get(key, 0) + value
+
+
+def _labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (f'{k}="{_escape(v)}"' for k, v in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render():
+    """Prometheus text exposition of all live workers' metrics"""
+    flush()
+    merged = {name: {} for name in _registry}
+    directory = _state['dir']
+    for name in os.listdir(directory) if directory else []:
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(directory, name)
+        pid = int(name[:-5]) if name[:-5].isdigit() else 0
+        if not _alive(pid):
+            # Snapshot of a worker that has exited
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path, 'r') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for metric_name, values in snapshot.items():
+            if metric_name in merged:
+                _merge(merged[metric_name], values)
+
+    with _lock:
+        for name, metric in _registry.items():
+            if metric.shared:
+                merged[name] = dict(metric.values)
+
+    lines = []
+    for name, metric in _registry.items():
+        lines.append(f'# HELP {name} {metric.help}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        for key, value in sorted(merged[name].items()):
+            if metric.kind != 'histogram':
+                lines.append(f'{name}{_labels(key)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets, value):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(key, [("le", bound)])} {cumulative}')
+            cumulative += value[len(metric.buckets)]
+            lines.append(f'{name}_bucket{_labels(key, [("le", "+Inf")])} {cumulative}')
+            lines.append(f'{name}_sum{_labels(key)} {round(value[-1], 6)}')
+            lines.append(f'{name}_count{_labels(key)} {cumulative}')
+    return '\n'.join(lines) + '\n'
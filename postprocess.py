@@ -0,0 +1,115 @@
+"""
+Post-processing stage for ffmpeg work (merging, audio extraction, MP3 conversion)
+yt-dlp runs its post-processors in the thread that downloaded the file. Here they
+are handed to a small pool of low-priority threads instead, and each run first
+takes one of POSTPROCESS_SLOTS host-wide slots (default: one per CPU core), so
+the number of ffmpeg processes stays bounded however many downloads are running.
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import metrics
+from locks import file_lock
+
+log = logging.getLogger(__name__)
+
+POSTPROCESS_SLOTS = int(os.environ.get('POSTPROCESS_SLOTS', os.cpu_count() or 1))
+FFMPEG_THREADS = int(os.environ.get('FFMPEG_THREADS', 2))  # per ffmpeg process, 0 lets ffmpeg decide
+POSTPROCESS_NICE = int(os.environ.get('POSTPROCESS_NICE', 10))
+SLOT_POLL_INTERVAL = 0.2  # seconds between attempts when every slot is busy
+
+
+def lower_priority(nice):
+    """Thread initializer that renices the calling thread"""
+    # Niceness is per thread on Linux and inherited by the ffmpeg processes it starts
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+    except (AttributeError, OSError):
+        pass
+
+
+class PostProcessPool:
+    """Queue between "download finished" and "post-process" with bounded ffmpeg concurrency"""
+
+    def __init__(self, lock_dir, slots=POSTPROCESS_SLOTS, threads=FFMPEG_THREADS, nice=POSTPROCESS_NICE):
+        self.lock_dir = lock_dir
+        self.slots = max(1, slots)
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=self.slots, thread_name_prefix='postprocess',
+                                           initializer=lower_priority, initargs=(nice,))
+        self.guard = threading.Lock()
+        self.waiting = 0
+        self.running = 0
+        self.started = 0
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @contextmanager
+    def _slot(self):
+        # Any free slot lock will do; all workers on the host share the same files
+        while True:
+            for i in range(self.slots):
+                with file_lock(os.path.join(self.lock_dir, f'slot-{i}.lock'), blocking=False) as acquired:
+                    if acquired:
+                        yield i
+                        return
+            time.sleep(SLOT_POLL_INTERVAL)
+
+    def run(self, fn, *args, **kwargs):
+        """Run fn in the pool once a slot is free and return its result"""
+        queued = time.time()
+        with self.guard:
+            self.waiting += 1
+
+        def task():
+            with self._slot():
+                waited = time.time() - queued
+                with self.guard:
+                    self.waiting -= 1
+                    self.running += 1
+                    self.started += 1
+                    self.wait_total += waited
+                    self.wait_max = max(self.wait_max, waited)
+                metrics.STAGE_SECONDS.observe(waited, stage='postprocess_wait')
+                if waited >= 1:
+                    log.info("Post-processing waited %.1fs for a slot", waited)
+                try:
+                    with metrics.STAGE_SECONDS.time(stage='postprocess'):
+                        return fn(*args, **kwargs)
+                finally:
+                    with self.guard:
+                        self.running -= 1
+                        self.completed += 1
+
+        return self.executor.submit(task).result()
+
+    def apply(self, ydl_opts):
+        """Add the ffmpeg thread limit to yt-dlp options"""
+        if self.threads > 0:
+            ydl_opts.setdefault('postprocessor_args', {}).setdefault('ffmpeg', []).extend(
+                ['-threads', str(self.threads)])
+        return ydl_opts
+
+    def attach(self, ydl):
+        """Route a YoutubeDL's post-processing (merge, ExtractAudio, ...) through the pool"""
+        post_process = ydl.post_process
+        ydl.post_process = lambda *args, **kwargs: self.run(post_process, *args, **kwargs)
+        return ydl
+
+    def stats(self):
+        with self.guard:
+            return {
+                'slots': self.slots,
+                'ffmpeg_threads': self.threads,
+                'waiting': self.waiting,
+                'running': self.running,
+                'completed': self.completed,
+                'avg_wait': round(self.wait_total / self.started, 2) if self.started else 0,
+                'max_wait': round(self.wait_max, 2),
+            }
@@ -0,0 +1,112 @@
+"""
+Speculative metadata prefetch while the user is still on the page
+The page asks for a prefetch once the URL field holds something that looks like a
+video link. Extraction then runs in a small low-priority pool, only when the rate
+limiter has tokens to spare, and each client address gets a fixed budget per
+window, so prefetching never competes with real downloads.
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from cache import SQLiteStore
+from postprocess import lower_priority
+
+log = logging.getLogger(__name__)
+
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', 1))  # per gunicorn worker, 0 disables
+PREFETCH_QUEUE_SIZE = 4  # waiting prefetches per worker; more are dropped
+PREFETCH_BUDGET = int(os.environ.get('PREFETCH_BUDGET', 20))  # prefetches per client per window
+PREFETCH_WINDOW = 600  # seconds
+PREFETCH_NICE = 10
+
+
+def is_prefetchable(url):
+    """True if url is an absolute http(s) URL with a host and a path or query"""
+    try:
+        parsed = urlparse(url)
+    except ValueError:
+        return False
+    return (parsed.scheme in ('http', 'https') and '.' in (parsed.hostname or '')
+            and (parsed.path.strip('/') or parsed.query) != '')
+
+
+class PrefetchBudget(SQLiteStore):
+    """Prefetches per client address in fixed windows, shared by all workers"""
+
+    def __init__(self, db_path, budget=PREFETCH_BUDGET, window=PREFETCH_WINDOW):
+        super().__init__(db_path)
+        self.budget = budget
+        self.window = window
+        with self._connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS budgets (
+                client TEXT PRIMARY KEY,
+                window_start REAL NOT NULL,
+                used INTEGER NOT NULL
+            )''')
+
+    def allow(self, client):
+        """Spend one prefetch from client's budget; False if none is left"""
+        now = time.time()
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT window_start, used FROM budgets WHERE client = ?', (client,)).fetchone()
+            if not row or now - row[0] >= self.window:
+                window_start, used = now, 0
+            else:
+                window_start, used = row
+            allowed = used < self.budget
+            if allowed:
+                db.execute('INSERT OR REPLACE INTO budgets (client, window_start, used) VALUES (?, ?, ?)',
+                           (client, window_start, used + 1))
+            # Forget clients whose window is over
+            db.execute('DELETE FROM budgets WHERE window_start < ?', (now - self.window,))
+            db.execute('COMMIT')
+        return allowed
+
+    def retry_after(self, client):
+        """Seconds until client's window resets"""
+        with self._connect() as db:
+            row = db.execute('SELECT window_start FROM budgets WHERE client = ?', (client,)).fetchone()
+        return max(1, int(row[0] + self.window - time.time())) if row else 1
+
+
+class Prefetcher:
+    """Low-priority threads running fn(url), each URL at most once at a time"""
+
+    def __init__(self, fn, workers=PREFETCH_WORKERS, max_queued=PREFETCH_QUEUE_SIZE, nice=PREFETCH_NICE):
+        self.fn = fn
+        self.workers = workers
+        self.max_pending = workers + max_queued
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='prefetch',
+                                           initializer=lower_priority, initargs=(nice,))
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def is_pending(self, url):
+        with self.lock:
+            return url in self.pending
+
+    def submit(self, url):
+        """Queue url; returns 'queued', 'pending' (already queued) or 'busy' (queue full)"""
+        with self.lock:
+            if url in self.pending:
+                return 'pending'
+            if self.workers <= 0 or len(self.pending) >= self.max_pending:
+                return 'busy'
+            self.pending.add(url)
+        self.executor.submit(self._run, url)
+        return 'queued'
+
+    def _run(self, url):
+        try:
+            self.fn(url)
+        except Exception as e:
+            log.debug("Prefetch of %s failed: %s", url, e)
+        finally:
+            with self.lock:
+                self.pending.discard(url)
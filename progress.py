@@ -0,0 +1,89 @@
+"""
+Download progress shared between the worker running a job and the clients watching it
+The downloading thread publishes to a small JSON file next to the job record
+(throttled, written atomically); /api/jobs/<id>/events streams it as Server-Sent
+Events, checking only the file's mtime between changes.
+"""
+
+import json
+import threading
+import time
+
+from locks import write_atomic
+
+PROGRESS_INTERVAL = 0.5  # seconds between byte-count updates (stage changes are written at once)
+
+# yt-dlp post-processor name -> stage shown to the user
+POSTPROCESSOR_STAGES = {
+    'Merger': 'merge',
+    'ExtractAudio': 'transcode',
+}
+
+
+class ProgressReporter:
+    """Collects progress from yt-dlp/pytubefix callbacks and publishes it to path"""
+
+    def __init__(self, path, interval=PROGRESS_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.state = {'stage': 'queued', 'downloaded': 0, 'total': None, 'speed': None, 'eta': None}
+        self.written = 0
+        self.download_started = None
+
+    def _publish(self, force=False):
+        # Without a path (e.g. synchronous downloads) progress is not published
+        if not self.path:
+            return
+        now = time.time()
+        if not force and now - self.written < self.interval:
+            return
+        self.written = now
+        write_atomic(self.path, json.dumps(dict(self.state, updated=now)))
+
+    def stage(self, name):
+        """Move to a new stage (extract, download, merge, transcode, ...)"""
+        with self.lock:
+            if self.state['stage'] != name:
+                self.state['stage'] = name
+                self._publish(force=True)
+
+    def update(self, downloaded, total=None, speed=None, eta=None):
+        with self.lock:
+            # pytubefix reports bytes only; estimate speed and ETA from them
+            now = time.time()
+            if self.download_started is None:
+                self.download_started = now
+            if speed is None and now > self.download_started:
+                speed = downloaded / (now - self.download_started)
+            if eta is None and speed and total:
+                eta = max(0, total - downloaded) / speed
+
+            self.state.update(stage='download', downloaded=downloaded, total=total,
+                              speed=round(speed) if speed else None, eta=round(eta) if eta else None)
+            self._publish()
+
+    def ytdlp_hook(self, d):
+        """yt-dlp progress_hooks entry"""
+        if d.get('status') == 'downloading':
+            self.update(d.get('downloaded_bytes') or 0, d.get('total_bytes') or d.get('total_bytes_estimate'),
+                        d.get('speed'), d.get('eta'))
+
+    def ytdlp_postprocessor_hook(self, d):
+        """yt-dlp postprocessor_hooks entry"""
+        if d.get('status') == 'started' and d.get('postprocessor') in POSTPROCESSOR_STAGES:
+            self.stage(POSTPROCESSOR_STAGES[d['postprocessor']])
+
+    def pytubefix_callback(self, stream, chunk, bytes_remaining):
+        """pytubefix on_progress callback"""
+        total = stream.filesize
+        self.update(total - bytes_remaining, total)
+
+
+def read_progress(path):
+    """Last published progress, or None"""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
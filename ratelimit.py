@@ -0,0 +1,143 @@
+"""
+Adaptive rate limiter shared by all gunicorn workers
+One token bucket per egress identity (cookie file + proxy), stored in SQLite.
+The refill rate follows AIMD: it creeps up while upstream is healthy and is
+halved (with a short pause) whenever a 429 or bot check is seen.
+"""
+
+import logging
+import os
+import time
+
+import metrics
+from cache import SQLiteStore
+
+log = logging.getLogger(__name__)
+
+RATE_MAX = float(os.environ.get('RATELIMIT_MAX_RATE', 0.5))  # downloads/sec per identity when healthy
+RATE_MIN = float(os.environ.get('RATELIMIT_MIN_RATE', 1 / 60))
+RATE_INCREASE = float(os.environ.get('RATELIMIT_INCREASE', 0.02))  # added per success
+RATE_DECREASE = float(os.environ.get('RATELIMIT_DECREASE', 0.5))  # multiplied per failure
+BURST = float(os.environ.get('RATELIMIT_BURST', 3))
+MAX_WAIT = float(os.environ.get('RATELIMIT_MAX_WAIT', 120))  # give up waiting after this long
+
+# Upstream messages that mean "slow down", not "this video is broken"
+RATE_LIMIT_MARKERS = (
+    '429',
+    'too many requests',
+    'sign in to confirm',
+    "confirm you're not a bot",
+    'confirm you’re not a bot',
+    'rate-limit',
+    'rate limit',
+    'bot detection',
+)
+
+
+class RateLimited(Exception):
+    """Raised when an identity stays throttled for longer than MAX_WAIT"""
+
+
+def is_rate_limited(error):
+    """True if an exception or message looks like upstream throttling"""
+    text = str(error).lower()
+    return any(marker in text for marker in RATE_LIMIT_MARKERS)
+
+
+class RateLimiter(SQLiteStore):
+    """Token buckets keyed by identity, with AIMD-adjusted refill rate"""
+
+    def __init__(self, db_path):
+        super().__init__(db_path)
+        with self._connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS buckets (
+                identity TEXT PRIMARY KEY,
+                rate REAL NOT NULL,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL,
+                paused_until REAL NOT NULL DEFAULT 0,
+                successes INTEGER NOT NULL DEFAULT 0,
+                failures INTEGER NOT NULL DEFAULT 0
+            )''')
+
+    def _load(self, db, identity, now):
+        row = db.execute('SELECT rate, tokens, updated, paused_until FROM buckets WHERE identity = ?',
+                         (identity,)).fetchone()
+        if not row:
+            db.execute('INSERT INTO buckets (identity, rate, tokens, updated) VALUES (?, ?, ?, ?)',
+                       (identity, RATE_MAX, BURST, now))
+            return RATE_MAX, BURST, 0
+        rate, tokens, updated, paused_until = row
+        return rate, min(BURST, tokens + (now - updated) * rate), paused_until
+
+    def acquire(self, identity, max_wait=MAX_WAIT, reserve=0):
+        """Take one token for identity, sleeping until one is available
+
+        Returns the seconds waited. Raises RateLimited after max_wait. Low-priority
+        callers pass reserve to leave that many tokens for everyone else.
+        """
+        started = time.time()
+        while True:
+            with self._connect() as db:
+                db.execute('BEGIN IMMEDIATE')
+                now = time.time()
+                rate, tokens, paused_until = self._load(db, identity, now)
+                if now < paused_until:
+                    wait = paused_until - now
+                elif tokens >= 1 + reserve:
+                    tokens -= 1
+                    wait = 0
+                else:
+                    wait = (1 + reserve - tokens) / rate
+                db.execute('UPDATE buckets SET tokens = ?, updated = ? WHERE identity = ?',
+                           (tokens, now, identity))
+                db.execute('COMMIT')
+
+            waited = time.time() - started
+            if wait == 0:
+                metrics.STAGE_SECONDS.observe(waited, stage='rate_limit')
+                if waited >= 0.1:
+                    log.info("Rate limiting: waited %.1fs for %s", waited, identity)
+                return waited
+            if waited + wait > max_wait:
+                raise RateLimited(f'Upstream is rate limiting {identity}, try again later')
+            time.sleep(wait)
+
+    def record_success(self, identity):
+        """Additive increase of the identity's rate"""
+        with self._connect() as db:
+            db.execute('UPDATE buckets SET rate = MIN(?, rate + ?), successes = successes + 1 WHERE identity = ?',
+                       (RATE_MAX, RATE_INCREASE, identity))
+
+    def record_failure(self, identity):
+        """Multiplicative decrease of the identity's rate, and pause it for one interval"""
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            rate, tokens, _ = self._load(db, identity, now)
+            rate = max(RATE_MIN, rate * RATE_DECREASE)
+            db.execute('''UPDATE buckets SET rate = ?, tokens = 0, updated = ?, paused_until = ?,
+                          failures = failures + 1 WHERE identity = ?''',
+                       (rate, now, now + 1 / rate, identity))
+            db.execute('COMMIT')
+        log.warning("Upstream throttled %s, slowing to %.1f downloads/min", identity, rate * 60)
+
+    def report(self, identity, error=None):
+        """Record the outcome of an upstream call: success, throttling, or neither"""
+        if error is None:
+            self.record_success(identity)
+        elif is_rate_limited(error):
+            self.record_failure(identity)
+
+    def stats(self):
+        """Current rate and counters per identity"""
+        with self._connect() as db:
+            rows = db.execute('SELECT identity, rate, successes, failures, paused_until FROM buckets').fetchall()
+        now = time.time()
+        return [{
+            'identity': identity,
+            'downloads_per_minute': round(rate * 60, 2),
+            'successes': successes,
+            'failures': failures,
+            'paused_for': round(max(0, paused_until - now), 1),
+        } for identity, rate, successes, failures, paused_until in rows]
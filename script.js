@@ -49,6 +49,48 @@ function updateQualityVisibility() {
 // Listen for URL input changes
 document.getElementById('urlInput').addEventListener('input', updateQualityVisibility);
 
+// Warm the server's metadata cache while the user is still choosing options,
+// once the URL has stopped changing and looks like a video link
+const PREFETCH_DELAY_MS = 600;
+let prefetchTimer = null;
+let lastPrefetchedURL = '';
+
+function looksLikeVideoURL(url) {
+    let parsed;
+    try {
+        parsed = new URL(url);
+    } catch (e) {
+        return false;
+    }
+    if (!['http:', 'https:'].includes(parsed.protocol) || !parsed.hostname.includes('.')) {
+        return false;
+    }
+    // YouTube links need a complete 11-character video id
+    if (isYouTubeURL(url)) {
+        return /(?:v=|youtu\.be\/|shorts\/|embed\/|live\/)[\w-]{11}(?![\w-])/.test(url);
+    }
+    return parsed.pathname.length > 1 || parsed.search.length > 1;
+}
+
+function schedulePrefetch() {
+    clearTimeout(prefetchTimer);
+    const url = document.getElementById('urlInput').value.trim();
+    if (url === lastPrefetchedURL || !looksLikeVideoURL(url)) {
+        return;
+    }
+    prefetchTimer = setTimeout(() => {
+        lastPrefetchedURL = url;
+        // Best effort: the download works the same without it
+        fetch(`${API_URL}/prefetch`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ url })
+        }).catch(() => {});
+    }, PREFETCH_DELAY_MS);
+}
+
+document.getElementById('urlInput').addEventListener('input', schedulePrefetch);
+
 // Update quality options when format type changes
 document.querySelectorAll('input[name="downloadType"]').forEach(radio => {
     radio.addEventListener('change', (e) => {
@@ -104,6 +146,8 @@ async function downloadFile() {
     const url = document.getElementById('urlInput').value.trim();
     const type = document.querySelector('input[name="downloadType"]:checked').value;
     const quality = document.getElementById('qualitySelect').value;
+    const start = document.getElementById('clipStart').value.trim();
+    const end = document.getElementById('clipEnd').value.trim();
     const downloadProgress = document.getElementById('downloadProgress');
     const error = document.getElementById('error');
 
@@ -114,52 +158,154 @@ async function downloadFile() {
         return;
     }
 
+    document.getElementById('progressText').textContent = 'Downloading... Please wait.';
     downloadProgress.classList.remove('hidden');
 
     try {
-        const response = await fetch(`${API_URL}/download`, {
+        // Progressive video and native audio formats stream straight to a native
+        // browser download (MP3 goes through the job queue for conversion, and
+        // clips to fetch only the requested part)
+        if (type !== 'mp3' && !start && !end) {
+            const streamUrl = `${API_URL}/stream?` + new URLSearchParams({ url, type, quality });
+            const probe = await fetch(streamUrl, { method: 'HEAD' });
+            if (probe.ok) {
+                startNativeDownload(streamUrl);
+                return;
+            }
+        }
+
+        const job = await submitDownloadJob(Object.assign(type === 'mp3'
+            ? { url, type: 'audio', audio_format: 'mp3', quality: parseInt(quality) }
+            : { url, type, quality: parseInt(quality) }, { start, end }));
+        const result = await waitForJob(job.job_id);
+
+        // Signed links support Range requests, so the browser can resume an
+        // interrupted download; files too big for the server cache use the job URL
+        const apiBase = new URL(API_URL, window.location.href);
+        startNativeDownload(new URL(result.download_url || result.result_url, apiBase).href);
+    } catch (err) {
+        showError(err.message);
+    } finally {
+        downloadProgress.classList.add('hidden');
+    }
+}
+
+// Let the browser download a URL itself instead of buffering it in memory
+function startNativeDownload(href) {
+    const a = document.createElement('a');
+    a.href = href;
+    a.download = '';
+    document.body.appendChild(a);
+    a.click();
+    document.body.removeChild(a);
+}
+
+// Queue a download job, retrying while the server queue is full
+async function submitDownloadJob(body) {
+    while (true) {
+        const response = await fetch(`${API_URL}/jobs`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
             },
-            body: JSON.stringify({
-                url,
-                type,
-                quality: parseInt(quality)
-            })
+            body: JSON.stringify(body)
         });
 
+        if (response.status === 503) {
+            const retryAfter = parseInt(response.headers.get('Retry-After')) || 15;
+            await sleep(retryAfter * 1000);
+            continue;
+        }
+
+        const data = await response.json();
         if (!response.ok) {
-            const data = await response.json();
             throw new Error(data.error || 'Download failed');
         }
+        return data;
+    }
+}
+
+// Follow a download job's progress until it has finished
+function waitForJob(jobId) {
+    if (!window.EventSource) {
+        return pollJob(jobId);
+    }
 
-        // Get filename from Content-Disposition header
-        const contentDisposition = response.headers.get('Content-Disposition');
-        let filename = 'download';
-        if (contentDisposition) {
-            const matches = /filename[^;=\n]*=((['"]).*?\2|[^;\n]*)/.exec(contentDisposition);
-            if (matches != null && matches[1]) {
-                filename = matches[1].replace(/['"]/g, '');
+    return new Promise((resolve, reject) => {
+        const source = new EventSource(`${API_URL}/jobs/${jobId}/events`);
+
+        source.addEventListener('progress', (e) => showProgress(JSON.parse(e.data)));
+        source.addEventListener('done', (e) => {
+            source.close();
+            resolve(JSON.parse(e.data));
+        });
+        source.addEventListener('failed', (e) => {
+            source.close();
+            reject(new Error(JSON.parse(e.data).error || 'Download failed'));
+        });
+        // The server ends each stream after a while and EventSource reconnects;
+        // only give up if the browser has stopped retrying
+        source.onerror = () => {
+            if (source.readyState === EventSource.CLOSED) {
+                pollJob(jobId).then(resolve, reject);
             }
+        };
+    });
+}
+
+// Poll a download job until it has finished (browsers without EventSource)
+async function pollJob(jobId) {
+    while (true) {
+        const response = await fetch(`${API_URL}/jobs/${jobId}`);
+        const data = await response.json();
+
+        if (!response.ok || data.status === 'error') {
+            throw new Error(data.error || 'Download failed');
+        }
+        if (data.status === 'done') {
+            return data;
+        }
+        if (data.progress) {
+            showProgress(data.progress);
         }
+        await sleep(2000);
+    }
+}
 
-        // Download the file
-        const blob = await response.blob();
-        const downloadUrl = window.URL.createObjectURL(blob);
-        const a = document.createElement('a');
-        a.href = downloadUrl;
-        a.download = filename;
-        document.body.appendChild(a);
-        a.click();
-        window.URL.revokeObjectURL(downloadUrl);
-        document.body.removeChild(a);
+const STAGE_TEXT = {
+    queued: 'Waiting in queue...',
+    extract: 'Fetching video info...',
+    merge: 'Merging video and audio...',
+    transcode: 'Converting audio...',
+};
 
-    } catch (err) {
-        showError(err.message);
-    } finally {
-        downloadProgress.classList.add('hidden');
+function showProgress(progress) {
+    const progressText = document.getElementById('progressText');
+
+    if (progress.stage !== 'download') {
+        progressText.textContent = STAGE_TEXT[progress.stage] || 'Downloading... Please wait.';
+        return;
     }
+
+    let text = 'Downloading...';
+    if (progress.total) {
+        text += ` ${Math.floor(progress.downloaded / progress.total * 100)}%`;
+    }
+    const details = [];
+    if (progress.speed) {
+        details.push(`${(progress.speed / 1048576).toFixed(1)} MB/s`);
+    }
+    if (progress.eta) {
+        details.push(`${progress.eta}s left`);
+    }
+    if (details.length) {
+        text += ` (${details.join(', ')})`;
+    }
+    progressText.textContent = text;
+}
+
+function sleep(ms) {
+    return new Promise(resolve => setTimeout(resolve, ms));
 }
 
 function showError(message) {
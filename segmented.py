@@ -0,0 +1,171 @@
+"""
+Segmented downloads: one file fetched as byte ranges over several connections
+Upstreams like YouTube throttle each connection, so large progressive files arrive
+faster in parallel pieces. The first range measures per-connection throughput;
+with the content length it decides the segment size and how many connections are
+worth opening. Segments are written at their offsets into a preallocated file,
+and a failed segment is retried from the byte where it stopped.
+"""
+
+import logging
+import math
+import os
+import queue
+import threading
+import time
+
+from sessions import http_session
+
+log = logging.getLogger(__name__)
+
+SEGMENT_CONNECTIONS = int(os.environ.get('SEGMENT_CONNECTIONS', 4))  # per file, 1 disables segmenting
+SEGMENT_SECONDS = 2.0  # target time for one segment on one connection
+SEGMENT_MIN = 1024 * 1024
+SEGMENT_MAX = 10 * 1024 * 1024  # YouTube throttles longer ranges
+SEGMENT_RETRIES = 3
+CHUNK_SIZE = 256 * 1024
+TIMEOUT = 30  # seconds
+
+
+class _Transfer:
+    """State shared by the threads downloading one file"""
+
+    def __init__(self, fd, total, on_progress):
+        self.fd = fd
+        self.total = total
+        self.on_progress = on_progress
+        self.lock = threading.Lock()
+        self.downloaded = 0
+        self.stop = threading.Event()
+        self.error = None
+
+    def write(self, offset, data):
+        os.pwrite(self.fd, data, offset)
+        with self.lock:
+            self.downloaded += len(data)
+            downloaded = self.downloaded
+        if self.on_progress:
+            # May raise (e.g. Cancelled) to abort the whole download
+            self.on_progress(downloaded, self.total)
+
+    def fail(self, error):
+        with self.lock:
+            self.error = self.error or error
+        self.stop.set()
+
+
+def _fetch(session, url, headers, transfer, start, end):
+    """Write bytes start..end (inclusive) at their offset, resuming after errors"""
+    position = start
+    for attempt in range(SEGMENT_RETRIES + 1):
+        try:
+            with session.get(url, headers=dict(headers, Range=f'bytes={position}-{end}'),
+                             stream=True, timeout=TIMEOUT) as response:
+                if response.status_code != 206:
+                    raise IOError(f'Range request answered {response.status_code}')
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    if transfer.stop.is_set():
+                        return
+                    chunk = chunk[:end + 1 - position]
+                    transfer.write(position, chunk)
+                    position += len(chunk)
+                    if position > end:
+                        return
+            raise IOError(f'Segment ended at {position} of {start}-{end}')
+        except (OSError, ValueError) as e:
+            # requests' connection and read errors are IOErrors too
+            if attempt == SEGMENT_RETRIES or transfer.stop.is_set():
+                raise
+            log.debug("Retrying segment %d-%d from %d: %s", start, end, position, e)
+            time.sleep(0.5 * (attempt + 1))
+
+
+def _worker(session, url, headers, transfer, segments):
+    while not transfer.stop.is_set():
+        try:
+            start, end = segments.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            _fetch(session, url, headers, transfer, start, end)
+        except BaseException as e:
+            transfer.fail(e)
+            return
+
+
+def plan(total, done, rate, connections=SEGMENT_CONNECTIONS):
+    """(segment size, connections) for the rest of a file, given per-connection bytes/s"""
+    remaining = total - done
+    size = int(min(SEGMENT_MAX, max(SEGMENT_MIN, rate * SEGMENT_SECONDS)))
+    # Another connection only pays off if one connection would need more than a segment's time
+    if remaining <= 0 or remaining / max(rate, 1) <= SEGMENT_SECONDS:
+        return size, 1
+    return size, max(1, min(connections, math.ceil(remaining / size)))
+
+
+def connections_for(size, connections=SEGMENT_CONNECTIONS):
+    """Parallel connections worth opening for size bytes when throughput is not known yet"""
+    return max(1, min(connections, math.ceil((size or 0) / SEGMENT_MAX)))
+
+
+def download(url, path, headers=None, proxy=None, on_progress=None, connections=SEGMENT_CONNECTIONS):
+    """Download url to path, in parallel ranges when the server supports them; returns path
+
+    on_progress(downloaded, total) is called from the download threads; an
+    exception it raises stops every connection and is re-raised here. Servers
+    without range support are read in one pass.
+    """
+    session = http_session(proxy)
+    headers = dict(headers or {})
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # The first range doubles as the probe for range support, size and throughput
+        started = time.time()
+        with session.get(url, headers=dict(headers, Range=f'bytes=0-{SEGMENT_MIN - 1}'),
+                         stream=True, timeout=TIMEOUT) as response:
+            response.raise_for_status()
+            if response.status_code == 206:
+                # Content-Range: bytes 0-1048575/<total>
+                total = response.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+                if not total.isdigit():
+                    raise IOError(f"Unknown size in Content-Range {response.headers.get('Content-Range')!r}")
+                total = int(total)
+                if hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(fd, 0, total)
+                else:
+                    os.ftruncate(fd, total)
+            else:
+                total = int(response.headers.get('Content-Length') or 0) or None
+
+            transfer = _Transfer(fd, total, on_progress)
+            for chunk in response.iter_content(CHUNK_SIZE):
+                transfer.write(transfer.downloaded, chunk)
+
+        if response.status_code != 206:
+            return path
+        if transfer.downloaded >= total:
+            os.ftruncate(fd, total)
+            return path
+
+        rate = transfer.downloaded / max(time.time() - started, 0.001)
+        size, count = plan(total, transfer.downloaded, rate, connections)
+        segments = queue.Queue()
+        for start in range(transfer.downloaded, total, size):
+            segments.put((start, min(start + size, total) - 1))
+        log.debug("Segmented download: %d bytes, %d connections, %d-byte segments at %.0f B/s",
+                  total, count, size, rate)
+
+        threads = [threading.Thread(target=_worker, args=(session, url, headers, transfer, segments),
+                                    name=f'segment-{n}', daemon=True) for n in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if transfer.error:
+            raise transfer.error
+        if transfer.downloaded != total:
+            raise IOError(f'Downloaded {transfer.downloaded} of {total} bytes')
+        return path
+    finally:
+        os.close(fd)
@@ -0,0 +1,162 @@
+"""
+Long-lived HTTP sessions and yt-dlp instances, reused across requests
+Each worker process keeps one keep-alive requests.Session per proxy and a few idle
+YoutubeDL instances per egress identity (cookie file + proxy), so requests skip
+TLS handshakes, cookie file parsing and extractor setup. A YoutubeDL is borrowed
+by one thread at a time; per-download options (format, output, hooks,
+post-processors) go on a lightweight YoutubeDL that shares its connections and
+cookies. Everything is created lazily and dropped after a fork.
+"""
+
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+YDL_POOL_SIZE = int(os.environ.get('YDL_POOL_SIZE', 4))  # idle YoutubeDL instances kept per identity
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))  # keep-alive connections per host and session
+
+_lock = threading.Lock()
+_sessions = {}
+_sessions_pid = [None]
+
+
+def http_session(proxy=None):
+    """This process's keep-alive requests.Session for proxy (None for direct)
+
+    requests sessions share their connection pool safely between threads; pass
+    per-request headers and options to the call, not to the session.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    with _lock:
+        if _sessions_pid[0] != os.getpid():
+            # Connections inherited from the parent must not be shared with it
+            _sessions.clear()
+            _sessions_pid[0] = os.getpid()
+        session = _sessions.get(proxy)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            if proxy:
+                session.proxies = {'http': proxy, 'https': proxy}
+            _sessions[proxy] = session
+        return session
+
+
+def _cookie_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except (OSError, TypeError):
+        return None
+
+
+class YdlPool:
+    """Idle YoutubeDL instances per egress identity, one borrower at a time"""
+
+    def __init__(self, size=YDL_POOL_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.pid = os.getpid()
+        self.created = 0
+        self.reused = 0
+
+    def _key(self, opts):
+        # A changed cookie file (refreshed or re-exported) gets fresh instances
+        cookiefile = opts.get('cookiefile')
+        return (cookiefile, _cookie_mtime(cookiefile), str(opts.get('cookiesfrombrowser')), opts.get('proxy'))
+
+    @contextmanager
+    def borrow(self, opts, **overrides):
+        """YoutubeDL for the identity in opts (base options from get_ydl_opts)
+
+        Instances are keyed by identity only, so opts must not carry per-request
+        settings; overrides are options yt-dlp reads at call time (e.g.
+        extract_flat, playlistend) and are undone when the block exits.
+        """
+        import yt_dlp
+
+        key = self._key(opts)
+        stale = []
+        with self.lock:
+            if self.pid != os.getpid():
+                self.idle.clear()
+                self.pid = os.getpid()
+            instances = self.idle.get(key)
+            ydl = instances.pop() if instances else None
+            if ydl is None:
+                self.created += 1
+                # Instances loaded from an older version of this identity's cookie file
+                for other in [k for k in self.idle if k != key and k[0] == key[0] and k[2:] == key[2:]]:
+                    stale.extend(self.idle.pop(other))
+            else:
+                self.reused += 1
+        for instance in stale:
+            self._discard(instance, save_cookies=False)
+        if ydl is None:
+            # YoutubeDL keeps and changes its params, so it gets its own copy
+            ydl = yt_dlp.YoutubeDL(dict(opts))
+
+        missing = object()
+        saved = {name: ydl.params.get(name, missing) for name in overrides}
+        ydl.params.update(overrides)
+        healthy = False
+        try:
+            yield ydl
+            healthy = True
+        finally:
+            for name, value in saved.items():
+                if value is missing:
+                    ydl.params.pop(name, None)
+                else:
+                    ydl.params[name] = value
+            self._release(key, ydl, healthy)
+
+    def _release(self, key, ydl, healthy):
+        with self.lock:
+            # Instances whose cookie file was replaced meanwhile are not kept
+            current = self._key(ydl.params) == key
+            instances = self.idle.setdefault(key, [])
+            if healthy and current and self.pid == os.getpid() and len(instances) < self.size:
+                instances.append(ydl)
+                return
+        self._discard(ydl, save_cookies=current)
+
+    def _discard(self, ydl, save_cookies=True):
+        """Close ydl; cookies are written back only if its cookie file is still the one it read"""
+        try:
+            if save_cookies:
+                ydl.save_cookies()
+            director = ydl.__dict__.pop('_request_director', None)
+            if director:
+                director.close()
+        except Exception as e:
+            log.debug("Closing YoutubeDL failed: %s", e)
+
+    def downloader(self, extractor, opts):
+        """Fresh YoutubeDL for one download, sharing extractor's cookie jar and connections
+
+        opts holds the per-download options. The extractor list is not loaded
+        (downloads start from extracted info), and the result must not be
+        closed: the connections belong to extractor.
+        """
+        import yt_dlp
+
+        ydl = yt_dlp.YoutubeDL(opts, auto_init=False)
+        ydl.__dict__['cookiejar'] = extractor.cookiejar
+        ydl.__dict__['_request_director'] = extractor._request_director
+        return ydl
+
+    def stats(self):
+        with self.lock:
+            return {
+                'idle': sum(len(instances) for instances in self.idle.values()),
+                'created': self.created,
+                'reused': self.reused,
+            }
@@ -0,0 +1,60 @@
+"""
+Short-lived signed URLs for finished downloads
+A URL carries its expiry and an HMAC of path + expiry, so any worker can check
+it without shared state. The key comes from DOWNLOAD_URL_SECRET, or is generated
+once per host and kept next to the caches so every worker uses the same one.
+"""
+
+import hashlib
+import hmac
+import os
+import secrets
+import time
+
+from locks import write_atomic
+
+DOWNLOAD_URL_TTL = int(os.environ.get('DOWNLOAD_URL_TTL', 3600))  # seconds
+
+
+def load_secret(path):
+    """Secret from the environment, else from path (created on first use)"""
+    if os.environ.get('DOWNLOAD_URL_SECRET'):
+        return os.environ['DOWNLOAD_URL_SECRET'].encode()
+
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    # The first worker to create the key wins; the others read the winner's
+    write_atomic(path, secrets.token_hex(32).encode(), mode=0o600, replace=False)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class UrlSigner:
+    """Sign and verify paths with an expiry"""
+
+    def __init__(self, secret, ttl=DOWNLOAD_URL_TTL):
+        self.secret = secret
+        self.ttl = ttl
+
+    def _signature(self, path, expires):
+        message = f'{path}\n{expires}'.encode()
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+
+    def sign(self, path):
+        """path with expires/sig query parameters appended"""
+        expires = int(time.time()) + self.ttl
+        return f'{path}?expires={expires}&sig={self._signature(path, expires)}'
+
+    def verify(self, path, expires, signature):
+        """True if the signature matches and has not expired"""
+        try:
+            expires = int(expires)
+        except (TypeError, ValueError):
+            return False
+        if expires < time.time():
+            return False
+        return hmac.compare_digest(self._signature(path, expires), signature or '')
@@ -0,0 +1,83 @@
+"""
+Stream single-file media straight from upstream to the client
+Bytes are forwarded as they arrive and optionally tee'd to disk for the result cache
+"""
+
+import os
+
+from sessions import http_session
+
+CHUNK_SIZE = 256 * 1024
+STREAM_PROTOCOLS = ('http', 'https')
+
+
+def select_stream_format(info, download_type, quality=None):
+    """Pick a format that can be sent as-is from one direct URL, or None
+
+    Video needs a progressive format (audio and video in one file, so no ffmpeg
+    merge); audio takes the best native audio-only stream.
+    """
+    candidates = [f for f in info.get('formats') or [info]
+                  if f.get('url') and f.get('protocol', 'https') in STREAM_PROTOCOLS]
+
+    if download_type == 'audio':
+        audio = [f for f in candidates if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+        # Stay within the requested bitrate if any format does
+        within = [f for f in audio if quality and (f.get('abr') or 0) <= quality]
+        audio = within or audio
+        audio.sort(key=lambda f: (f.get('ext') == 'm4a', f.get('abr') or 0), reverse=True)
+        return audio[0] if audio else None
+
+    # A merged download would get the tallest video within quality; a progressive
+    # format is only good enough at that height (YouTube's stop at 360p)
+    best = max((f.get('height') or 0 for f in info.get('formats') or [info]
+                if f.get('vcodec') != 'none' and (not quality or (f.get('height') or 0) <= quality)), default=0)
+    video = [f for f in candidates
+             if f.get('vcodec') != 'none' and f.get('acodec') != 'none'
+             and f.get('ext') == 'mp4' and (f.get('height') or 0) >= best
+             and (not quality or (f.get('height') or 0) <= quality)]
+    video.sort(key=lambda f: (f.get('height') or 0, f.get('tbr') or 0), reverse=True)
+    return video[0] if video else None
+
+
+def open_upstream(fmt, proxy=None):
+    """Start the upstream GET for a format; the caller must close the response
+
+    Uses the worker's keep-alive session, so the connection goes back to its
+    pool once the response is closed.
+    """
+    response = http_session(proxy).get(
+        fmt['url'],
+        headers=fmt.get('http_headers') or {},
+        stream=True,
+        timeout=30,
+    )
+    response.raise_for_status()
+    return response
+
+
+def relay(upstream, tee_path=None, on_complete=None):
+    """Yield upstream chunks to the client, copying them to tee_path if given
+
+    on_complete(tee_path) runs only when the whole body arrived; a partial
+    copy (client went away, upstream failed) is deleted.
+    """
+    expected = int(upstream.headers.get('Content-Length') or 0)
+    received = 0
+    tee = open(tee_path, 'wb') if tee_path else None
+    complete = False
+    try:
+        for chunk in upstream.iter_content(CHUNK_SIZE):
+            if tee:
+                tee.write(chunk)
+            received += len(chunk)
+            yield chunk
+        complete = not expected or received == expected
+    finally:
+        upstream.close()
+        if tee:
+            tee.close()
+            if complete and on_complete:
+                on_complete(tee_path)
+            elif os.path.exists(tee_path):
+                os.remove(tee_path)
@@ -2,15 +2,34 @@
 """
 Auto-update cookies.txt from cnvmp3.com
 Fetches fresh YouTube cookies to avoid bot detection
+
+Run once from the command line, or call start_refresher() from the app: every
+worker starts a refresher thread, but only the one holding the host-wide lock
+refreshes; the others wait and take over if that worker exits. Workers pick up
+the new file through its mtime (see identities.py).
 """
 
-import requests
 import os
+import json
 import hashlib
-from datetime import datetime
+import logging
+import threading
+import time
+
+from locks import file_lock, write_atomic
+from sessions import http_session
 
+log = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 COOKIES_URL = 'https://cnvmp3.com/cookies.txt'
-COOKIES_FILE = 'cookies.txt'
+COOKIES_FILE = os.path.join(BASE_DIR, 'cookies.txt')
+
+# ETag/Last-Modified of the last download (dot-prefixed so it never matches cookies*.txt)
+META_FILE = os.path.join(BASE_DIR, '.cookies.txt.meta')
+LOCK_FILE = os.path.join(BASE_DIR, '.cookies-refresh.lock')
+
+REFRESH_INTERVAL = int(os.environ.get('COOKIE_REFRESH_INTERVAL', 3600))  # seconds, 0 disables
 
 def get_file_hash(filepath):
     """Get MD5 hash of file contents"""
@@ -19,10 +38,20 @@ def get_file_hash(filepath):
     with open(filepath, 'rb') as f:
         return hashlib.md5(f.read()).hexdigest()
 
+def load_meta():
+    """Validators saved from the last successful fetch"""
+    try:
+        with open(META_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
 def update_cookies():
     """Fetch and update cookies.txt if changed"""
+    import requests
+
     try:
-        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Checking for cookie updates from cnvmp3.com...")
+        log.info("Checking for cookie updates from cnvmp3.com")
 
         # Get current hash
         old_hash = get_file_hash(COOKIES_FILE)
@@ -33,37 +62,69 @@ def update_cookies():
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
             'Accept-Language': 'en-US,en;q=0.9',
         }
-        response = requests.get(COOKIES_URL, headers=headers, timeout=10)
+
+        # Conditional request: skip the body if nothing changed since last time
+        meta = load_meta() if old_hash else {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        response = http_session().get(COOKIES_URL, headers=headers, timeout=10)
+        if response.status_code == 304:
+            log.info("Cookies are up-to-date (not modified)")
+            return False
         response.raise_for_status()
 
         new_content = response.text
         new_hash = hashlib.md5(new_content.encode()).hexdigest()
 
+        write_atomic(META_FILE, json.dumps({
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }))
+
         # Check if changed
         if old_hash == new_hash:
-            print(f"[OK] Cookies are up-to-date (hash: {old_hash[:8]}...)")
+            log.info("Cookies are up-to-date (hash: %s...)", old_hash[:8])
             return False
 
         # Update file
-        with open(COOKIES_FILE, 'w', encoding='utf-8') as f:
-            f.write(new_content)
+        write_atomic(COOKIES_FILE, new_content)
 
-        print(f"[UPDATE] Cookies updated successfully!")
-        print(f"  Old hash: {old_hash[:8] if old_hash else 'none'}...")
-        print(f"  New hash: {new_hash[:8]}...")
-        print(f"  Size: {len(new_content)} bytes")
+        log.info("Cookies updated (hash %s... -> %s..., %d bytes)",
+                 old_hash[:8] if old_hash else 'none', new_hash[:8], len(new_content))
         return True
 
     except requests.RequestException as e:
-        print(f"[ERROR] Failed to fetch cookies: {e}")
         if os.path.exists(COOKIES_FILE):
-            print(f"[OK] Using existing cookies.txt file")
+            log.warning("Failed to fetch cookies, using existing cookies.txt: %s", e)
         else:
-            print(f"[WARNING] No cookies.txt file available!")
+            log.error("Failed to fetch cookies and no cookies.txt file available: %s", e)
         return False
     except Exception as e:
-        print(f"[ERROR] Unexpected error: {e}")
+        log.exception("Unexpected error updating cookies: %s", e)
         return False
 
+def refresh_forever(interval):
+    """Refresh cookies every interval seconds while holding the host-wide lock"""
+    with file_lock(LOCK_FILE):
+        log.info("Cookie refresher running in process %d (every %ds)", os.getpid(), interval)
+        while True:
+            update_cookies()
+            time.sleep(interval)
+
+_refresher = None
+
+def start_refresher(interval=REFRESH_INTERVAL):
+    """Start the background refresher thread for this process (idempotent)"""
+    global _refresher
+    if interval <= 0 or (_refresher and _refresher.is_alive()):
+        return _refresher
+    _refresher = threading.Thread(target=refresh_forever, args=(interval,), name='cookie-refresher', daemon=True)
+    _refresher.start()
+    return _refresher
+
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
     update_cookies()